@@ -0,0 +1,277 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+from openai import OpenAI
+from pydantic import ValidationError
+
+from transcriptprocessor import STAGE_DEPENDENCIES, STAGE_SCHEMAS, STAGES, TranscriptProcessor, validation_hint
+
+BATCH_ENDPOINT = '/v1/chat/completions'
+MAX_BATCH_REQUESTS = 50000
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class BatchTranscriptProcessor:
+    """Runs the analysis pipeline through the OpenAI Batch API.
+
+    Stages run one after another for every pending transcript: the requests of a
+    stage are written as JSONL, submitted as one or more batches, and the results
+    are saved as regular stage outputs, which is what the next stage reads. The
+    submitted batch ids are kept in `<state_dir>/<stage>.json`, so an interrupted
+    run polls the same batches again instead of resubmitting them. A result that
+    does not match the stage schema is requested again through the processor's
+    stage_call, which repairs it with the live API.
+    """
+
+    def __init__(self, processor: TranscriptProcessor, client: OpenAI = None,
+                 state_dir: str = './processed-transcripts/batch', poll_interval: int = 60):
+        self.processor = processor
+        # Point OPENAI_BASE_URL at a local stand-in to run this without the real endpoint.
+        self.client = client or OpenAI(api_key=processor.openai_client.api_key)
+        self.state_dir = state_dir
+        self.poll_interval = poll_interval
+        os.makedirs(state_dir, exist_ok=True)
+
+    def run(self):
+        processor = self.processor
+        raw_files = [raw_file for raw_file in processor.raw_files
+                     if not processor.is_processed(raw_file)]
+        logger.info(f"Starting batch processing of {len(raw_files)} transcripts")
+
+        for step in STAGES:
+            self.run_stage(step, raw_files)
+
+        for raw_file in raw_files:
+            validated_data = processor.load_response(raw_file, 'validate_and_document')
+            if validated_data is not None and processor.save_response(raw_file, validated_data):
+                processor.seen_index.add('processed-transcripts', processor.processed_id(raw_file))
+
+        processor.metrics.export(processor.prometheus_textfile)
+
+    def run_stage(self, step: str, raw_files: List[str]):
+        while True:
+            state = self._load_state(step)
+            resumed = state is not None
+            if state is None:
+                state = self._plan(step, raw_files)
+                if state is None:
+                    logger.info(f"No pending requests for stage {step}")
+                    return
+
+            self._submit(state)
+            results = self._wait(state)
+            self._apply(step, state, results)
+            os.remove(self._state_path(step))
+
+            # A resumed batch may predate files added since; plan again for those.
+            if not resumed:
+                return
+
+    def _stage_contents(self, step: str, raw_file: str) -> Optional[Tuple[List[str], str]]:
+        """User messages for one file at this stage and their fingerprint, or None when
+        the saved output is up to date or the previous stage has no output for it."""
+        processor = self.processor
+        inputs = []
+        for dependency in STAGE_DEPENDENCIES[step]:
+            if dependency == 'transcript':
+                inputs.append(processor.read_transcript(raw_file))
+            else:
+                inputs.append(processor.load_response(raw_file, dependency))
+        if any(data is None for data in inputs):
+            return None
+
+        contents = processor.stage_contents(step, *inputs)
+        fingerprint = processor.stage_fingerprint(step, contents)
+        checkpoints = processor.load_checkpoints(raw_file)
+        if processor.reusable_output(raw_file, step, fingerprint, checkpoints) is not None:
+            if checkpoints.get(step) != fingerprint:
+                self._checkpoint(raw_file, step, fingerprint)
+            return None
+        return contents, fingerprint
+
+    def _checkpoint(self, raw_file: str, step: str, fingerprint: str):
+        checkpoints = self.processor.load_checkpoints(raw_file)
+        checkpoints[step] = fingerprint
+        self.processor.save_checkpoints(raw_file, checkpoints)
+
+    def _plan(self, step: str, raw_files: List[str]) -> Optional[Dict[str, Any]]:
+        requests = {}
+        fingerprints = {}
+        lines = []
+        for raw_file in raw_files:
+            try:
+                pending = self._stage_contents(step, raw_file)
+            except (FileNotFoundError, IOError) as e:
+                logger.exception(f"An error occurred while reading file {raw_file}: {e}")
+                continue
+            if pending is None or not pending[0]:
+                continue
+
+            contents, fingerprints[raw_file] = pending
+            requests[raw_file] = len(contents)
+            for index, content in enumerate(contents):
+                lines.append(json.dumps({
+                    "custom_id": self._custom_id(raw_file, index),
+                    "method": "POST",
+                    "url": BATCH_ENDPOINT,
+                    "body": self.processor.stage_params(step, content),
+                }))
+
+        if not lines:
+            return None
+
+        chunks = []
+        for start in range(0, len(lines), MAX_BATCH_REQUESTS):
+            path = os.path.join(self.state_dir, f'{step}-{len(chunks)}.jsonl')
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines[start:start + MAX_BATCH_REQUESTS]) + '\n')
+            chunks.append({'input_path': path, 'batch_id': None})
+
+        state = {'step': step, 'requests': requests, 'fingerprints': fingerprints, 'chunks': chunks}
+        self._save_state(step, state)
+        logger.info(f"Planned {len(lines)} requests for {len(requests)} files in stage {step}")
+        return state
+
+    def _submit(self, state: Dict[str, Any]):
+        for chunk in state['chunks']:
+            if chunk['batch_id'] is not None:
+                continue
+
+            with open(chunk['input_path'], 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose='batch')
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window='24h',
+                metadata={'stage': state['step']},
+            )
+            chunk['batch_id'] = batch.id
+            self._save_state(state['step'], state)
+            logger.info(f"Submitted batch {batch.id} for stage {state['step']}")
+
+    def _wait(self, state: Dict[str, Any]) -> Dict[str, str]:
+        results = {}
+        for chunk in state['chunks']:
+            batch = self.client.batches.retrieve(chunk['batch_id'])
+            while batch.status not in TERMINAL_STATUSES:
+                logger.info(f"Batch {batch.id} for stage {state['step']} is {batch.status}: {batch.request_counts}")
+                time.sleep(self.poll_interval)
+                batch = self.client.batches.retrieve(chunk['batch_id'])
+
+            if batch.status != 'completed':
+                logger.error(f"Batch {batch.id} for stage {state['step']} ended as {batch.status}")
+            if batch.error_file_id:
+                self._log_errors(self.client.files.content(batch.error_file_id).text)
+            if batch.output_file_id:
+                results.update(self._parse_output(state['step'], self.client.files.content(batch.output_file_id).text))
+        return results
+
+    def _parse_output(self, step: str, text: str) -> Dict[str, str]:
+        results = {}
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            raw_file = item['custom_id'].rsplit('#', 1)[0]
+            if response.get('status_code') == 200:
+                body = response['body']
+                results[item['custom_id']] = body['choices'][0]['message']['content']
+                self.processor.metrics.record(step, raw_file, body.get('model'), body.get('usage'), batch=True)
+            else:
+                logger.error(f"Batch request {item['custom_id']} failed: {item.get('error') or response}")
+                self.processor.metrics.record(step, raw_file, None, error=str(response.get('status_code')),
+                                              batch=True)
+        return results
+
+    @staticmethod
+    def _log_errors(text: str):
+        for line in text.splitlines():
+            if line.strip():
+                item = json.loads(line)
+                logger.error(f"Batch request {item.get('custom_id')} failed: {item.get('error') or item.get('response')}")
+
+    def _apply(self, step: str, state: Dict[str, Any], results: Dict[str, str]):
+        processor = self.processor
+        schema = STAGE_SCHEMAS[step]
+        outputs = {}
+        invalid = {}
+        for raw_file, count in state['requests'].items():
+            contents = [results.get(self._custom_id(raw_file, index)) for index in range(count)]
+            if any(content is None for content in contents):
+                logger.error(f"Stage {step} is incomplete for {raw_file}, it will be retried on the next run")
+                continue
+
+            outputs[raw_file] = []
+            for index, content in enumerate(contents):
+                try:
+                    outputs[raw_file].append(schema.model_validate_json(content).model_dump())
+                except ValidationError as e:
+                    logger.warning(f"Batch result {self._custom_id(raw_file, index)} does not match "
+                                   f"{schema.__name__}, repairing it: {validation_hint(e)}")
+                    outputs[raw_file].append(None)
+                    invalid[self._custom_id(raw_file, index)] = (raw_file, index)
+
+        if invalid:
+            self._repair(step, state, invalid, outputs)
+
+        for raw_file, data in outputs.items():
+            if any(item is None for item in data):
+                continue
+            if step == 'open_coding':
+                output = [processor.annotate(item, raw_file) for item in data]
+            elif step == 'segment_transcript':
+                output = processor.annotate(processor.merge_segmentations(data), raw_file)
+            else:
+                output = processor.annotate(data[0], raw_file)
+            fingerprint = state.get('fingerprints', {}).get(raw_file)
+            if processor.save_response(raw_file, output, step) and fingerprint is not None:
+                self._checkpoint(raw_file, step, fingerprint)
+
+    def _repair(self, step: str, state: Dict[str, Any], invalid: Dict[str, Tuple[str, int]],
+                outputs: Dict[str, List[Optional[Dict[str, Any]]]]):
+        """Requests the invalid results of a batch again through stage_call. Files whose
+        results still cannot be repaired are left without output for this stage."""
+        messages = {}
+        for chunk in state['chunks']:
+            with open(chunk['input_path'], 'r') as f:
+                for line in f:
+                    request = json.loads(line)
+                    if request['custom_id'] in invalid:
+                        messages[request['custom_id']] = request['body']['messages'][-1]['content']
+
+        async def repair(custom_id):
+            raw_file, index = invalid[custom_id]
+            try:
+                outputs[raw_file][index] = await self.processor.stage_call(step, messages[custom_id], raw_file)
+            except Exception as e:
+                logger.error(f"Could not repair batch result {custom_id}, it will be retried on the next run: {e}")
+
+        async def repair_all():
+            await asyncio.gather(*(repair(custom_id) for custom_id in invalid if custom_id in messages))
+
+        asyncio.run(repair_all())
+
+    @staticmethod
+    def _custom_id(raw_file: str, index: int) -> str:
+        return f'{raw_file}#{index}'
+
+    def _state_path(self, step: str) -> str:
+        return os.path.join(self.state_dir, f'{step}.json')
+
+    def _load_state(self, step: str) -> Optional[Dict[str, Any]]:
+        path = self._state_path(step)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _save_state(self, step: str, state: Dict[str, Any]):
+        path = self._state_path(step)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(f'{path}.tmp', path)
@@ -1,33 +1,95 @@
-from ratelimit import limits, sleep_and_retry
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+from ratelimiter import SourceBudget
 from scraperadapter import ScraperAdapter
 
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+
+def is_review_element(name, attrs):
+    if name == 'meta':
+        return attrs.get('itemprop') == 'ratingValue'
+    if name == 'div':
+        classes = attrs.get('class') or ''
+        if isinstance(classes, str):
+            classes = classes.split()
+        return 'review__body' in classes
+    return False
+
+
+# Only rating metas and review bodies are built into the tree; everything else on
+# the page is skipped by the parser.
+REVIEW_STRAINER = SoupStrainer(is_review_element)
+
+
+def parse_reviews(content):
+    """Returns the reviews on a page with the rating of the nearest preceding
+    ratingValue meta, walking the strained document once in order."""
+    soup = BeautifulSoup(content, PARSER, parse_only=REVIEW_STRAINER)
+    reviews = []
+    rating = None
+    for element in soup.find_all(True, recursive=False):
+        if element.name == 'meta':
+            rating = element.get('content')
+        else:
+            reviews.append({
+                'text': element.text.strip(),
+                'rating': rating
+            })
+    return reviews
+
+
 class G2Adapter(ScraperAdapter):
-    @sleep_and_retry
-    @limits(calls=10, period=60)  # Be respectful to the website
+    def __init__(self, budget=None, prefetch=3):
+        self.budget = budget or SourceBudget('g2', calls=10, period=60)
+        self.prefetch = prefetch
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'Mozilla/5.0'})
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=prefetch))
+
     def scrape(self, query, max_results=100):
         base_url = f"https://www.g2.com/products/{query}/reviews"
         reviews = []
         page = 1
+        in_flight = deque()
 
-        while len(reviews) < max_results:
-            url = f"{base_url}?page={page}"
-            response = requests.get(url, headers={'User-Agent': 'Mozilla/5.0'})
-            soup = BeautifulSoup(response.content, 'html.parser')
+        # Up to `prefetch` pages are requested ahead of the one being consumed; the
+        # budget still spaces out the actual requests.
+        with ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix='g2-page') as pool:
+            while len(reviews) < max_results:
+                while len(in_flight) < self.prefetch:
+                    in_flight.append(pool.submit(self.fetch_reviews, f"{base_url}?page={page}"))
+                    page += 1
 
-            new_reviews = soup.find_all('div', class_='review__body')
-            if not new_reviews:
-                break
-
-            for review in new_reviews:
-                if len(reviews) >= max_results:
+                new_reviews = in_flight.popleft().result()
+                if not new_reviews:
                     break
-                reviews.append({
-                    'text': review.text.strip(),
-                    'rating': review.find_previous('meta', itemprop='ratingValue')['content']
-                })
 
-            page += 1
+                reviews.extend(new_reviews[:max_results - len(reviews)])
+
+            for future in in_flight:
+                future.cancel()
+
+        return reviews
+
+    def fetch_reviews(self, url):
+        response = self.budget.call('g2.reviews', self.fetch_page, url)
+        return parse_reviews(response.content) if response is not None else []
+
+    def fetch_page(self, url):
+        response = self.session.get(url, timeout=30)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response
 
-        return reviews
\ No newline at end of file
+    def close(self):
+        self.session.close()
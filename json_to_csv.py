@@ -1,327 +1,373 @@
 import csv
+import hashlib
 import json
 import os
+from concurrent.futures import ProcessPoolExecutor
 from loguru import logger
-
-
-def segment_transcript_json_to_csv():
-    fieldnames = [
-        'id', 'source', 'url', 'segment_index', 'segment_topic',
-        'segment_start_time', 'segment_end_time', 'segment_content'
-    ]
-
-    json_directory = "./processed-transcripts/json/segment_transcript"
-    output_csv_file_path = "./processed-transcripts/csv/segment_transcript"
-
-    os.makedirs(output_csv_file_path, exist_ok=True)
-
-    output_csv_file = f'{output_csv_file_path}/segment_transcript.csv'
-
+from pydantic import ValidationError
+
+from models import (AffinityMappingSchema, CodingSchema, SegmentationSchema, ThematicAnalysisSchema,
+                    ValidationAndRefinementSchema)
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+JSON_DIRECTORY = "./processed-transcripts/json"
+CSV_DIRECTORY = "./processed-transcripts/csv"
+
+# Output tables: the stage directory they are built from, the CSV they are written
+# to (relative to CSV_DIRECTORY) and their columns.
+TABLES = {
+    'segment_transcript': {
+        'stage': 'segment_transcript',
+        'csv': 'segment_transcript/segment_transcript.csv',
+        'fields': ['id', 'source', 'url', 'segment_index', 'segment_topic',
+                   'segment_start_time', 'segment_end_time', 'segment_content', 'segment_main_idea'],
+    },
+    'open_coding': {
+        'stage': 'open_coding',
+        'csv': 'open_coding/open_coding.csv',
+        'fields': ['id', 'source', 'url', 'segment_index', 'segment', 'excerpt', 'code'],
+    },
+    'themes': {
+        'stage': 'clustering_and_thematic_analysis',
+        'csv': 'clustering_and_thematic_analysis/themes.csv',
+        'fields': ['id', 'source', 'url', 'theme_name', 'cluster_name', 'code'],
+    },
+    'affinity_map': {
+        'stage': 'affinity_mapping_and_persona_development',
+        'csv': 'affinity_mapping_and_persona_development/affinity_map.csv',
+        'fields': ['id', 'source', 'url', 'relationships'],
+    },
+    'user_personas': {
+        'stage': 'affinity_mapping_and_persona_development',
+        'csv': 'affinity_mapping_and_persona_development/user_personas.csv',
+        'fields': ['id', 'source', 'url', 'persona_name', 'background', 'goals', 'motivations',
+                   'needs', 'challenges', 'behaviors', 'attitudes', 'relevant_quotes'],
+    },
+    'findings': {
+        'stage': 'validate_and_document',
+        'csv': 'validate_and_document/findings.csv',
+        'fields': ['id', 'source', 'url', 'key_findings', 'insights', 'recommendations'],
+    },
+    'refinements': {
+        'stage': 'validate_and_document',
+        'csv': 'validate_and_document/refinements.csv',
+        'fields': ['id', 'source', 'url', 'aspect', 'original', 'refined', 'rationale'],
+    },
+}
+
+FILES_PER_TASK = 200
+
+# What was exported from each stage output file, used by incremental exports to
+# find new, changed and deleted files.
+MANIFEST_PATH = os.path.join(CSV_DIRECTORY, 'export-manifest.json')
+
+
+def _common(data):
+    return {'id': data.get('id', ''), 'source': data.get('source', ''), 'url': data.get('url', '')}
+
+
+def flatten_segment_transcript(data):
+    segmentation = SegmentationSchema.model_validate(data)
+    for index, segment in enumerate(segmentation.segments):
+        yield 'segment_transcript', dict(_common(data),
+                                         segment_index=index,
+                                         segment_topic=segment.title,
+                                         segment_start_time=segment.start_time,
+                                         segment_end_time=segment.end_time,
+                                         segment_content=segment.content,
+                                         segment_main_idea=segment.main_idea)
+
+
+def flatten_open_coding(data):
+    # One CodingSchema per transcript segment, in segment order.
+    for index, ele in enumerate(data):
+        coding = CodingSchema.model_validate(ele)
+        for segment in coding.segments:
+            for excerpt in segment.excerpts:
+                yield 'open_coding', dict(_common(ele),
+                                          segment_index=index,
+                                          segment=segment.segment,
+                                          excerpt=excerpt.text,
+                                          code=excerpt.code)
+
+
+def flatten_clustering_and_thematic_analysis(data):
+    analysis = ThematicAnalysisSchema.model_validate(data)
+    for theme in analysis.themes:
+        for cluster in theme.clusters:
+            for code in cluster.codes:
+                yield 'themes', dict(_common(data), theme_name=theme.theme_name,
+                                     cluster_name=cluster.cluster_name, code=code)
+
+
+def flatten_affinity_mapping_and_persona_development(data):
+    mapping = AffinityMappingSchema.model_validate(data)
+    yield 'affinity_map', dict(_common(data), relationships=mapping.relationships)
+    for persona in mapping.personas:
+        row = persona.model_dump()
+        row['persona_name'] = row.pop('name')
+        yield 'user_personas', dict(_common(data), **row)
+
+
+def flatten_validate_and_document(data):
+    validation = ValidationAndRefinementSchema.model_validate(data)
+    yield 'findings', dict(_common(data), key_findings=validation.key_findings,
+                           insights=validation.insights, recommendations=validation.recommendations)
+    for refinement in validation.refinements:
+        yield 'refinements', dict(_common(data), **refinement.model_dump())
+
+
+# Flatteners yield (table, row) pairs. Row values keep their native types, lists
+# included; only the CSV sink turns them into text.
+FLATTENERS = {
+    'segment_transcript': flatten_segment_transcript,
+    'open_coding': flatten_open_coding,
+    'clustering_and_thematic_analysis': flatten_clustering_and_thematic_analysis,
+    'affinity_mapping_and_persona_development': flatten_affinity_mapping_and_persona_development,
+    'validate_and_document': flatten_validate_and_document,
+}
+
+
+def flatten_file(stage, file_path):
+    """Returns ({table: [row values in TABLES column order]}, manifest entry) for one
+    stage output. A file that cannot be read or does not match its schema has no rows."""
+    rows = {}
+    entry = {'size': None, 'mtime': None, 'hash': None, 'keys': []}
     try:
-        with open(output_csv_file, mode='w', newline='', encoding='utf-8') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for json_file in os.listdir(json_directory):
-                if json_file.endswith('.json'):
-                    file_path = os.path.join(json_directory, json_file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
-
-                            for index, segment in enumerate(data.get('segments', [])):
-                                for content in segment.get('content', []):
-                                    row = {
-                                        'id': data.get('id'),
-                                        'source': data.get('source'),
-                                        'url': data.get('url'),
-                                        'segment_index': index,
-                                        'segment_topic': segment.get('topic'),
-                                        'segment_start_time': segment.get('start_time'),
-                                        'segment_end_time': segment.get('end_time'),
-                                        'segment_content': content
-                                    }
-                                    writer.writerow(row)
-                        logger.info(f"Successfully processed file: {json_file}")
-
-                    except json.JSONDecodeError:
-                        logger.error(f"JSON decoding failed for file: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing file {file_path}: {e}")
-
-    except IOError as e:
-        logger.critical(f"Failed to write CSV file: {e}")
+        stat = os.stat(file_path)
+        with open(file_path, 'rb') as file:
+            content = file.read()
+        entry.update(size=stat.st_size, mtime=stat.st_mtime, hash=hashlib.sha256(content).hexdigest())
+
+        data = loads(content)
+        for table, row in FLATTENERS[stage](data):
+            rows.setdefault(table, []).append([row.get(field) for field in TABLES[table]['fields']])
+        # Keys as they read back from the CSV, where None is an empty string.
+        entry['keys'] = sorted({tuple('' if value is None else str(value) for value in row[:2])
+                                for table_rows in rows.values() for row in table_rows})
+    except ValueError as e:
+        # JSONDecodeError and pydantic's ValidationError are both ValueErrors.
+        if isinstance(e, ValidationError):
+            logger.error(f"File {file_path} does not match the {stage} schema, rerun the stage: {e}")
+        else:
+            logger.error(f"JSON decoding failed for file: {file_path}")
+        rows = {}
     except Exception as e:
-        logger.critical(f"Unexpected error: {e}")
+        logger.error(f"Unexpected error processing file {file_path}: {e}")
+        rows = {}
+    return rows, entry
 
 
-def open_coding_json_to_csv():
-    fieldnames = [
-        "id", "source", "url",
-        "segment_start", "segment_end", "segment_text",
-        "significant_words", "initial_codes"
-    ]
+def flatten_files(stage, file_paths):
+    """Worker task: flattens a batch of files of one stage into row batches per table,
+    along with the manifest entry of every file."""
+    batch = {}
+    entries = {}
+    for file_path in file_paths:
+        rows, entries[file_path] = flatten_file(stage, file_path)
+        for table, table_rows in rows.items():
+            batch.setdefault(table, []).extend(table_rows)
+    return batch, entries
 
-    json_directory = "./processed-transcripts/json/open_coding"
-    output_csv_file_path = "./processed-transcripts/csv/open_coding"
 
-    os.makedirs(output_csv_file_path, exist_ok=True)
+def flattened_batches(tasks, workers):
+    """Yields ((stage, file paths), flatten_files result) for each task, in task
+    order, flattening in a pool of `workers` processes when there is more than one task."""
+    if workers <= 1 or len(tasks) <= 1:
+        for stage, file_paths in tasks:
+            yield (stage, file_paths), flatten_files(stage, file_paths)
+        return
 
-    output_csv_file = f'{output_csv_file_path}/open_coding.csv'
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        yield from zip(tasks, executor.map(flatten_files, *zip(*tasks)))
 
-    try:
-        with open(output_csv_file, mode='w', newline='', encoding='utf-8') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for json_file in os.listdir(json_directory):
-                if json_file.endswith('.json'):
-                    file_path = os.path.join(json_directory, json_file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
-
-                            for ele in data:
-                                for segment in ele.get('segments', []):
-                                    row = {
-                                        'id': ele.get('id', ''),
-                                        'source': ele.get('source', ''),
-                                        'url': ele.get('url', ''),
-                                        'segment_start': segment.get('start', ''),
-                                        'segment_end': segment.get('end', ''),
-                                        'segment_text': segment.get('text', ''),
-                                        'significant_words': ', '.join(segment.get('significant_words', [])),
-                                        'initial_codes': ', '.join(segment.get('initial_codes', []))
-                                    }
-                                    writer.writerow(row)
-
-                        logger.info(f"Successfully processed file: {json_file}")
-
-                    except json.JSONDecodeError:
-                        logger.error(f"JSON decoding failed for file: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing file {file_path}: {e}")
 
-    except IOError as e:
-        logger.critical(f"Failed to write CSV file: {e}")
-    except Exception as e:
-        logger.critical(f"Unexpected error: {e}")
+def csv_value(value):
+    if isinstance(value, list):
+        return ', '.join(str(item) for item in value)
+    return value
 
 
-def themes_json_to_csv():
-    fieldnames = [
-        "id", "source", "url", "theme_name", "code"
-    ]
+def list_stage_files(stage):
+    directory = os.path.join(JSON_DIRECTORY, stage)
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json')]
 
-    json_directory = "./processed-transcripts/json/clustering_and_thematic_analysis"
-    output_csv_file_path = "./processed-transcripts/csv/clustering_and_thematic_analysis"
 
-    os.makedirs(output_csv_file_path, exist_ok=True)
+def file_hash(file_path):
+    with open(file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
 
-    output_csv_file = f'{output_csv_file_path}/themes.csv'
 
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    try:
+        with open(MANIFEST_PATH, 'rb') as file:
+            return loads(file.read())
+    except (IOError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable export manifest {MANIFEST_PATH}: {e}")
+        return None
+
+
+def save_manifest(manifest):
+    os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+    with open(f'{MANIFEST_PATH}.tmp', 'w') as file:
+        json.dump(manifest, file)
+    os.replace(f'{MANIFEST_PATH}.tmp', MANIFEST_PATH)
+
+
+def plan_stage(stage, manifest):
+    """Decides how the tables of a stage are brought up to date.
+
+    Returns (mode, files to flatten, (id, source) keys whose rows are dropped,
+    manifest entries of files that are kept as they are). The mode is 'full' when
+    the tables have to be rebuilt, 'append' when there are only new files,
+    'rewrite' when files changed or were deleted and 'skip' when nothing did.
+    """
+    files = list_stage_files(stage)
+    tables = [table for table in TABLES if TABLES[table]['stage'] == stage]
+    previous = (manifest or {}).get('stages', {}).get(stage)
+    up_to_date = manifest is not None and previous is not None and all(
+        manifest.get('fields', {}).get(table) == TABLES[table]['fields']
+        and os.path.exists(os.path.join(CSV_DIRECTORY, TABLES[table]['csv']))
+        # Any other size means the CSV was written by something else, or by an export
+        # that did not finish.
+        and os.path.getsize(os.path.join(CSV_DIRECTORY, TABLES[table]['csv']))
+        == manifest.get('csv_sizes', {}).get(table)
+        for table in tables)
+    if not up_to_date:
+        return 'full', files, set(), {}
+
+    pending = []
+    kept = {}
+    removed = set()
+    for file_path in files:
+        entry = previous.get(file_path)
+        if entry is None:
+            pending.append(file_path)
+            continue
+        stat = os.stat(file_path)
+        if stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+            kept[file_path] = entry
+        elif stat.st_size == entry['size'] and file_hash(file_path) == entry['hash']:
+            kept[file_path] = dict(entry, mtime=stat.st_mtime)
+        else:
+            pending.append(file_path)
+            removed.update(tuple(key) for key in entry['keys'])
+
+    for file_path in set(previous) - set(files):
+        removed.update(tuple(key) for key in previous[file_path]['keys'])
+
+    if removed:
+        return 'rewrite', pending, removed, kept
+    return ('append' if pending else 'skip'), pending, removed, kept
+
+
+def open_table(table, mode, manifest, removed):
+    """Opens the CSV of a table for writing according to the stage plan. Returns the
+    file and the path it has to be moved to once complete (None if written in place)."""
+    path = os.path.join(CSV_DIRECTORY, TABLES[table]['csv'])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if mode == 'append':
+        return open(path, mode='a', newline='', encoding='utf-8', buffering=1024 * 1024), None
+
+    target = f'{path}.tmp' if mode == 'rewrite' else path
+    file = open(target, mode='w', newline='', encoding='utf-8', buffering=1024 * 1024)
+    writer = csv.writer(file)
+    writer.writerow(TABLES[table]['fields'])
+    if mode == 'rewrite':
+        with open(path, mode='r', newline='', encoding='utf-8') as existing:
+            reader = csv.reader(existing)
+            next(reader, None)
+            writer.writerows(row for row in reader if (row[0], row[1]) not in removed)
+    return file, (path if mode == 'rewrite' else None)
+
+
+def export(tables=None, workers=None, incremental=False):
+    """Writes the CSVs of `tables` (all by default) in a single pass over the stage
+    outputs. Files are read and flattened by a pool of `workers` processes; row
+    batches come back in file order and are streamed into buffered csv writers.
+
+    With `incremental`, only files that are new or changed since the last export
+    (per the export manifest) are read: their rows are appended, and rows of changed
+    or deleted files are filtered out of the existing CSVs by (id, source).
+    """
+    stages = list(dict.fromkeys(TABLES[table]['stage'] for table in (tables or TABLES)))
+    # A stage's tables share its manifest entries, so they are always exported together.
+    tables = [table for table in TABLES if TABLES[table]['stage'] in stages]
+    workers = workers or os.cpu_count() or 1
+
+    manifest = load_manifest() or {'fields': {}, 'csv_sizes': {}, 'stages': {}}
+    previous = manifest if incremental else None
+    plans = {stage: plan_stage(stage, previous) for stage in stages}
+    tasks = [(stage, files[start:start + FILES_PER_TASK])
+             for stage, (mode, files, removed, kept) in plans.items()
+             for start in range(0, len(files), FILES_PER_TASK)]
+
+    files = {}
+    replacements = {}
     try:
-        with open(output_csv_file, mode='w', newline='', encoding='utf-8') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for json_file in os.listdir(json_directory):
-                if json_file.endswith('.json'):
-                    file_path = os.path.join(json_directory, json_file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
-
-                            for theme_name, theme_data in data.get('themes', {}).items():
-                                codes = theme_data.get('codes', [])
-                                for code in codes:
-                                    row = {
-                                        'id': data.get('id', ''),
-                                        'source': data.get('source', ''),
-                                        'url': data.get('url', ''),
-                                        'theme_name': theme_name,
-                                        'code': code
-                                    }
-                                    writer.writerow(row)
-
-                        logger.info(f"Successfully processed file: {json_file}")
-
-                    except json.JSONDecodeError:
-                        logger.error(f"JSON decoding failed for file: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing file {file_path}: {e}")
+        for table in tables:
+            mode, _, removed, _ = plans[TABLES[table]['stage']]
+            if mode != 'skip':
+                files[table], replacements[table] = open_table(table, mode, previous, removed)
+        writers = {table: csv.writer(file) for table, file in files.items()}
+        for stage, (mode, pending, removed, kept) in plans.items():
+            logger.info(f"Exporting {stage}: {mode}, {len(pending)} files to read, {len(kept)} unchanged")
+            manifest['stages'][stage] = dict(kept)
+
+        for (stage, file_paths), (batch, entries) in flattened_batches(tasks, workers):
+            for table, rows in batch.items():
+                if table in writers:
+                    writers[table].writerows([csv_value(value) for value in row] for row in rows)
+            manifest['stages'][stage].update(entries)
+            logger.info(f"Exported {len(file_paths)} {stage} files")
+
+        for table, file in files.items():
+            file.close()
+            if replacements[table] is not None:
+                os.replace(file.name, replacements[table])
+        for table in tables:
+            manifest['fields'][table] = TABLES[table]['fields']
+            manifest['csv_sizes'][table] = os.path.getsize(os.path.join(CSV_DIRECTORY, TABLES[table]['csv']))
+        save_manifest(manifest)
 
     except IOError as e:
         logger.critical(f"Failed to write CSV file: {e}")
     except Exception as e:
         logger.critical(f"Unexpected error: {e}")
+    finally:
+        for file in files.values():
+            file.close()
 
 
-import os
-import csv
-import json
-import logging
-
-
-def affinity_map_and_user_personas_json_to_csv():
-    affinity_fieldnames = [
-        "id", "source", "url", "theme_name", "code"
-    ]
-
-    user_personas_fieldnames = [
-        "id", "source", "url", "persona_name", "age", "role",
-        "goals", "challenges", "motivations"
-    ]
-
-    json_directory = "./processed-transcripts/json/affinity_mapping_and_persona_development"
-    output_csv_file_path = "./processed-transcripts/csv/affinity_mapping_and_persona_development"
+def segment_transcript_json_to_csv():
+    export(['segment_transcript'])
 
-    os.makedirs(output_csv_file_path, exist_ok=True)
 
-    affinity_csv_file = f'{output_csv_file_path}/affinity_map.csv'
-    user_personas_csv_file = f'{output_csv_file_path}/user_personas.csv'
+def open_coding_json_to_csv():
+    export(['open_coding'])
 
-    try:
-        with open(affinity_csv_file, mode='w', newline='', encoding='utf-8') as affinity_file, \
-                open(user_personas_csv_file, mode='w', newline='', encoding='utf-8') as personas_file:
-
-            affinity_writer = csv.DictWriter(affinity_file, fieldnames=affinity_fieldnames)
-            personas_writer = csv.DictWriter(personas_file, fieldnames=user_personas_fieldnames)
-
-            affinity_writer.writeheader()
-            personas_writer.writeheader()
-
-            for json_file in os.listdir(json_directory):
-                if json_file.endswith('.json'):
-                    file_path = os.path.join(json_directory, json_file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
-
-                            # Write affinity_map data to CSV
-                            for theme_name, theme_data in data.get('affinity_map', {}).items():
-                                codes = theme_data.get('codes', [])
-                                for code in codes:
-                                    affinity_row = {
-                                        'id': data.get('id', ''),
-                                        'source': data.get('source', ''),
-                                        'url': data.get('url', ''),
-                                        'theme_name': theme_name,
-                                        'code': code
-                                    }
-                                    affinity_writer.writerow(affinity_row)
-
-                            # Write user_personas data to CSV
-                            for persona in data.get('user_personas', []):
-                                personas_row = {
-                                    'id': data.get('id', ''),
-                                    'source': data.get('source', ''),
-                                    'url': data.get('url', ''),
-                                    'persona_name': persona.get('name', ''),
-                                    'age': persona.get('age', ''),
-                                    'role': persona.get('role', ''),
-                                    'goals': ', '.join(persona.get('goals', [])),
-                                    'challenges': ', '.join(persona.get('challenges', [])),
-                                    'motivations': ', '.join(persona.get('motivations', []))
-                                }
-                                personas_writer.writerow(personas_row)
-
-                        logger.info(f"Successfully processed file: {json_file}")
-
-                    except json.JSONDecodeError:
-                        logger.error(f"JSON decoding failed for file: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing file {file_path}: {e}")
 
-    except IOError as e:
-        logger.critical(f"Failed to write CSV file: {e}")
-    except Exception as e:
-        logger.critical(f"Unexpected error: {e}")
+def themes_json_to_csv():
+    export(['themes'])
 
 
-import os
-import csv
-import json
-import logging
+def affinity_map_and_user_personas_json_to_csv():
+    export(['affinity_map', 'user_personas'])
 
 
 def process_json_to_csv():
-    affinity_fieldnames = ["id", "source", "url", "section", "theme_name", "code"]
-    user_personas_fieldnames = ["id", "source", "url", "persona_name", "age", "role",
-                                "goals", "challenges", "motivations"]
-
-    json_directory = "./processed-transcripts/json/validate_and_document"
-    output_csv_file_path = "./processed-transcripts/csv/validate_and_document"
-
-    os.makedirs(output_csv_file_path, exist_ok=True)
-
-    affinity_csv_file = f'{output_csv_file_path}/affinity_map.csv'
-    user_personas_csv_file = f'{output_csv_file_path}/user_personas.csv'
-
-    try:
-        with open(affinity_csv_file, mode='w', newline='', encoding='utf-8') as affinity_file, \
-                open(user_personas_csv_file, mode='w', newline='', encoding='utf-8') as personas_file:
-
-            affinity_writer = csv.DictWriter(affinity_file, fieldnames=affinity_fieldnames)
-            personas_writer = csv.DictWriter(personas_file, fieldnames=user_personas_fieldnames)
-
-            affinity_writer.writeheader()
-            personas_writer.writeheader()
-
-            for json_file in os.listdir(json_directory):
-                if json_file.endswith('.json'):
-                    file_path = os.path.join(json_directory, json_file)
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as file:
-                            data = json.load(file)
-
-                            common_fields = {
-                                'id': data.get('id', ''),
-                                'source': data.get('source', ''),
-                                'url': data.get('url', '')
-                            }
-
-                            def process_affinity_map(section, section_data):
-                                for theme_name, theme_data in section_data.items():
-                                    codes = theme_data.get('codes', [])
-                                    for code in codes:
-                                        row = dict(common_fields, section=section, theme_name=theme_name, code=code)
-                                        affinity_writer.writerow(row)
-
-                            # Write affinity_map and clusters data to CSV
-                            process_affinity_map("affinity_map",
-                                                 data.get('review', {}).get('personas', {}).get('affinity_map', {}))
-                            process_affinity_map("clusters",
-                                                 data.get('review', {}).get('clusters', {}).get('themes', {}))
-
-                            # Write user_personas data to CSV
-                            for persona in data.get('review', {}).get('personas', {}).get('user_personas', []):
-                                row = dict(common_fields,
-                                           persona_name=persona.get('name', ''),
-                                           age=persona.get('age', ''),
-                                           role=persona.get('role', ''),
-                                           goals=', '.join(persona.get('goals', [])),
-                                           challenges=', '.join(persona.get('challenges', [])),
-                                           motivations=', '.join(persona.get('motivations', []))
-                                           )
-                                personas_writer.writerow(row)
-
-                        logger.info(f"Successfully processed file: {json_file}")
-
-                    except json.JSONDecodeError:
-                        logger.error(f"JSON decoding failed for file: {file_path}")
-                    except Exception as e:
-                        logger.error(f"Unexpected error processing file {file_path}: {e}")
-
-    except IOError as e:
-        logger.critical(f"Failed to write CSV file: {e}")
-    except Exception as e:
-        logger.critical(f"Unexpected error: {e}")
+    export(['findings', 'refinements'])
 
 
-def json_to_csv():
-    segment_transcript_json_to_csv()
-    open_coding_json_to_csv()
-    themes_json_to_csv()
-    affinity_map_and_user_personas_json_to_csv()
-    process_json_to_csv()
+def json_to_csv(workers=None, incremental=False):
+    export(workers=workers, incremental=incremental)
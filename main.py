@@ -1,19 +1,29 @@
 import os
 import time
 import json
+import asyncio
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
 from distutils.log import fatal
 
 from dotenv import load_dotenv
 from loguru import logger
 
 from json_to_csv import json_to_csv
+from parquetexport import json_to_parquet
+from processedstore import ProcessedStore
 from youtubeaudiodownloader import YouTubeAudioDownloader
 from g2adapter import G2Adapter
+from ratelimiter import SourceBudget
+from seenindex import SeenIndex
+from segmentstore import SegmentStore
 from redditadapter import RedditAdapter
 from twitteradapter import TwitterAdapter
 from youtubeadapter import YouTubeAdapter
-from transcriptprocessor import TranscriptProcessor
+from transcriptprocessor import STAGES, TranscriptProcessor
+from batchprocessor import BatchTranscriptProcessor
+from responsecache import ResponseCache
 
 
 def load_env():
@@ -30,10 +40,15 @@ def get_configs(configs):
             "client_secret": configs.get("REDDIT_CLIENT_SECRET"),
             "user_agent": configs.get("REDDIT_USER_AGENT"),
             "threshold_criteria": None,
+            "budget": {"calls": 60, "period": 60},
+            "comment_depth": int(configs.get("REDDIT_COMMENT_DEPTH", 3)),
+            "replace_more_limit": int(configs.get("REDDIT_REPLACE_MORE_LIMIT", 0)),
         },
         'youtube': {
             "api_key": configs.get("YOUTUBE_API_KEY"),
             "threshold_criteria": None,
+            "budget": {"calls": 100, "period": 100, "quota": int(configs.get("YOUTUBE_QUOTA", 10000))},
+            "transcript_workers": int(configs.get("YOUTUBE_TRANSCRIPT_WORKERS", 8)),
         },
         'twitter': {
             "auth_info": {
@@ -42,17 +57,49 @@ def get_configs(configs):
                 "password": configs.get("TWITTER_AUTH_INFO_PASSWORD"),
             },
             "language": "en-US",
+            "cookies_file": configs.get("TWITTER_COOKIES_FILE", "./configs/twitter-cookies.json"),
             "threshold_criteria": None,
+            "budget": {"calls": 50, "period": 900},
+        },
+        'g2': {
+            "budget": {"calls": 10, "period": 60},
+        },
+        'audio': {
+            "download_path": './audio_files',
+            "options": {
+                "workers": int(configs.get("AUDIO_DOWNLOAD_WORKERS", 2)),
+                "max_queue": int(configs.get("AUDIO_DOWNLOAD_QUEUE_SIZE", 100)),
+                "disk_quota": int(configs["AUDIO_DISK_QUOTA_MB"]) * 1024 * 1024
+                if configs.get("AUDIO_DISK_QUOTA_MB") else None,
+            },
         }
     }
     return app_configs
 
 
-def add_adapters(app_configs, scraper, sources):
+def parse_source_timeouts(value):
+    timeouts = {}
+    if not value:
+        return timeouts
+    for item in value.split(','):
+        source, _, seconds = item.partition('=')
+        timeouts[source.strip()] = float(seconds)
+    return timeouts
+
+
+def add_adapters(app_configs, scraper, sources, raw_store=None):
     sources = sources.split(',')
+    seen_index = SeenIndex()
     for source in sources:
+        if source in app_configs and isinstance(app_configs[source].get('budget'), dict):
+            app_configs[source]['budget'] = SourceBudget(source, **app_configs[source]['budget'])
+        if source in ('youtube', 'reddit', 'twitter'):
+            app_configs[source]['seen_index'] = seen_index
+            app_configs[source]['raw_store'] = raw_store
+
         if source == 'youtube':
-            downloader = YouTubeAudioDownloader('./audio_files')
+            downloader = YouTubeAudioDownloader(app_configs['audio']['download_path'], **app_configs['audio']['options'])
+            downloader.start()
             app_configs[source]['downloader'] = downloader
             scraper.add_adapter('youtube', YouTubeAdapter(**app_configs[source]))
         elif source == 'reddit':
@@ -60,49 +107,148 @@ def add_adapters(app_configs, scraper, sources):
         elif source == 'twitter':
             scraper.add_adapter('twitter', TwitterAdapter(**app_configs[source]))
         elif source == 'g2':
-            scraper.add_adapter('g2', G2Adapter())
+            scraper.add_adapter('g2', G2Adapter(**app_configs[source]))
         else:
             logger.exception(f"Invalid source: {source}")
             return
 
 
+class ScrapeResult:
+    def __init__(self, query):
+        self.query = query
+        self.results = {}
+        self.finished = []
+        self.failed = {}
+        self.timed_out = []
+        self.elapsed = 0.0
+
+    def summary(self):
+        return {
+            'query': self.query,
+            'finished': self.finished,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'counts': {name: len(items) for name, items in self.results.items() if isinstance(items, list)},
+            'elapsed': round(self.elapsed, 2),
+        }
+
+
 class MultiSourceScraper:
-    def __init__(self):
+    def __init__(self, timeout=None, source_timeouts=None, query_concurrency=1):
         self.adapters = {}
+        self.timeout = timeout
+        self.source_timeouts = source_timeouts or {}
+        self.query_concurrency = query_concurrency
+        self.executor = None
+        self.loop = None
+        self.loop_thread = None
 
     def add_adapter(self, name, adapter):
         self.adapters[name] = adapter
 
+    def _get_executor(self):
+        if self.executor is None:
+            max_workers = max(1, len(self.adapters)) * self.query_concurrency
+            self.executor = ThreadPoolExecutor(max_workers=max_workers,
+                                               thread_name_prefix='scraper')
+        return self.executor
+
+    def _get_loop(self):
+        # All async adapters share one event loop running in a background thread,
+        # so clients that keep state on the loop (e.g. twikit sessions) stay valid.
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, name='scraper-loop', daemon=True)
+            self.loop_thread.start()
+        return self.loop
+
+    def _submit(self, adapter, query, max_results):
+        if asyncio.iscoroutinefunction(adapter.scrape):
+            return asyncio.run_coroutine_threadsafe(adapter.scrape(query, max_results), self._get_loop())
+        return self._get_executor().submit(adapter.scrape, query, max_results)
+
     def scrape(self, query, max_results=100):
-        results = {}
+        result = ScrapeResult(query)
+        start = time.monotonic()
+
+        futures = {}
         for name, adapter in self.adapters.items():
+            logger.info(f"Starting scrape for {name}")
+            futures[name] = self._submit(adapter, query, max_results)
+
+        for name, future in futures.items():
+            timeout = self.source_timeouts.get(name, self.timeout)
+            remaining = None if timeout is None else max(0.0, start + timeout - time.monotonic())
             try:
-                logger.info(f"Starting scrape for {name}")
-                results[name] = adapter.scrape(query, max_results)
+                result.results[name] = future.result(timeout=remaining)
+                result.finished.append(name)
                 logger.info(f"Finished scrape for {name}")
+            except FutureTimeoutError:
+                # Coroutines are cancelled on the loop; a sync adapter keeps its worker
+                # thread until it returns, but its result is discarded.
+                future.cancel()
+                logger.error(f"Scrape for {name} timed out after {timeout} seconds")
+                result.results[name] = []
+                result.timed_out.append(name)
             except Exception as e:
                 logger.exception(f"Error scraping {name}: {str(e)}")
-                results[name] = []
-        return results
+                result.results[name] = []
+                result.failed[name] = str(e)
+
+        result.elapsed = time.monotonic() - start
+        return result
+
+    def scrape_many(self, queries, max_results=100):
+        """Yields a ScrapeResult per query as each one finishes, keeping at most
+        query_concurrency queries in flight. Sources are rate limited by their
+        adapter's SourceBudget, which every query shares."""
+        with ThreadPoolExecutor(max_workers=self.query_concurrency, thread_name_prefix='query') as pool:
+            futures = {pool.submit(self.scrape, query, max_results): query for query in queries}
+            for future in as_completed(futures):
+                yield future.result()
+
+    def close(self):
+        for name, adapter in self.adapters.items():
+            if hasattr(adapter, 'close'):
+                logger.info(f"Closing {name} adapter")
+                adapter.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop_thread.join()
+            self.loop.close()
+            self.loop = None
+            self.loop_thread = None
 
 
 def scrape_action(args, app_configs, configs):
-    scraper = MultiSourceScraper()
-    add_adapters(app_configs, scraper, args.scrape_sources)
+    scraper = MultiSourceScraper(timeout=args.scrape_timeout,
+                                 source_timeouts=parse_source_timeouts(args.source_timeouts),
+                                 query_concurrency=max(1, args.query_concurrency))
+    raw_store = SegmentStore() if args.raw_storage == 'segments' else None
+    add_adapters(app_configs, scraper, args.scrape_sources, raw_store)
 
     queries = []
 
     if args.query_file:
         with open(args.query_file, 'r') as file:
             queries = file.readlines()
-        queries = [query.strip() for query in queries]
+        queries = [query.strip() for query in queries if query.strip()]
     else:
         queries = [args.query]
 
-    for query in queries:
-        logger.info(f"Starting scraping with query: {query} and max_results: {args.max_results}")
-        results = scraper.scrape(query, max_results=args.max_results)
-        logger.info(f"Results: {results}")
+    logger.info(f"Starting scraping of {len(queries)} queries with max_results: {args.max_results} "
+                f"and query_concurrency: {scraper.query_concurrency}")
+    try:
+        for done, result in enumerate(scraper.scrape_many(queries, max_results=args.max_results), 1):
+            logger.debug(f"Results for {result.query}: {result.results}")
+            logger.info(f"[{done}/{len(queries)}] Scrape summary: {result.summary()}")
+    finally:
+        scraper.close()
+        if raw_store is not None:
+            raw_store.close()
 
     time_since = time.time() - start_time
     logger.info(f"Time since start: {time_since} seconds")
@@ -113,29 +259,147 @@ def process_transcript_action(args, openai_key):
         os.makedirs('./processed-transcripts/')
 
     logger.info("Starting transcript processing for YouTube results")
-    results = {args.transcript_source: os.listdir(f"./raw/{args.transcript_source}/")}
+    raw_store = SegmentStore() if args.raw_storage == 'segments' else None
+    if raw_store is not None:
+        results = {args.transcript_source: [f"{item_id}.json" for item_id in raw_store.ids(args.transcript_source)]}
+    else:
+        results = {args.transcript_source: os.listdir(f"./raw/{args.transcript_source}/")}
     transcript_processor = TranscriptProcessor(openai_key, args.transcript_source,
-                                               results.get(args.transcript_source, []))
-    transcript_processor.process_transcripts()
+                                               results.get(args.transcript_source, []),
+                                               concurrency=max(1, args.transcript_concurrency),
+                                               segment_concurrency=max(1, args.segment_concurrency),
+                                               requests_per_minute=args.openai_rpm,
+                                               tokens_per_minute=args.openai_tpm,
+                                               cache=ResponseCache(
+                                                   max_bytes=args.cache_max_mb * 1024 * 1024,
+                                                   max_age=args.cache_max_age_days * 86400
+                                                   if args.cache_max_age_days else None,
+                                                   bypass=args.no_cache),
+                                               rerun_from=args.rerun_from,
+                                               chunk_tokens=args.chunk_tokens,
+                                               prometheus_textfile=args.prometheus_textfile,
+                                               max_retries=args.openai_max_retries,
+                                               max_concurrent_requests=max(1, args.openai_max_concurrency),
+                                               raw_store=raw_store,
+                                               processed_store=ProcessedStore())
+    if args.batch:
+        BatchTranscriptProcessor(transcript_processor, poll_interval=args.batch_poll_interval).run()
+    else:
+        transcript_processor.process_transcripts()
     logger.info("Finished transcript processing for YouTube results")
 
     time_since = time.time() - start_time
     logger.info(f"Time since start: {time_since} seconds")
 
 
-def json_to_csv_action():
-    json_to_csv()
+def import_raw_action(args):
+    """Copies the ./raw/<source>/<id>.json files of --scrape_sources (default: every
+    source directory) into the segment store."""
+    sources = args.scrape_sources.split(',') if args.scrape_sources else [
+        entry.name for entry in os.scandir('./raw') if entry.is_dir() and entry.name != 'store']
+    store = SegmentStore()
+    try:
+        for source in sources:
+            store.import_directory(source, f"./raw/{source}/")
+    finally:
+        store.close()
+
+
+def compact_raw_action(args):
+    store = SegmentStore()
+    try:
+        sources = args.scrape_sources.split(',') if args.scrape_sources else [
+            entry.name for entry in os.scandir(store.directory) if entry.is_dir()]
+        for source in sources:
+            store.compact(source)
+    finally:
+        store.close()
+
+
+def import_processed_action(args):
+    store = ProcessedStore()
+    try:
+        store.import_json()
+    finally:
+        store.close()
+
+
+def json_to_csv_action(args):
+    if args.export_format == 'parquet':
+        json_to_parquet(workers=args.export_workers)
+    elif args.export_from == 'database':
+        store = ProcessedStore()
+        try:
+            store.export_csv()
+        finally:
+            store.close()
+    else:
+        json_to_csv(workers=args.export_workers, incremental=args.incremental)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Multi-source scraper and transcript processor")
-    parser.add_argument('action', choices=['scrape', 'process-transcript', 'json_to_csv'], help="Action to perform")
+    parser.add_argument('action', choices=['scrape', 'process-transcript', 'json_to_csv', 'import-raw', 'compact-raw',
+                                           'import-processed'],
+                        help="Action to perform")
     parser.add_argument('--scrape_sources', type=str, help="Source of scrape")
     parser.add_argument('--transcript_source', choices=['youtube'], required=False, help="Source of transcript")
     parser.add_argument('--query', type=str, help="Search query")
     parser.add_argument('--query_file', type=str, help="File containing list of queries")
     parser.add_argument('--max_results', type=int, default=100, help="Maximum number of results to scrape")
+    parser.add_argument('--scrape_timeout', type=float, default=None,
+                        help="Per-source timeout in seconds for a single query")
+    parser.add_argument('--source_timeouts', type=str,
+                        help="Per-source timeout overrides, e.g. youtube=600,reddit=120")
+    parser.add_argument('--query_concurrency', type=int, default=1,
+                        help="Number of queries from --query_file to scrape at once")
+    parser.add_argument('--transcript_concurrency', type=int, default=4,
+                        help="Number of transcripts to process at once")
+    parser.add_argument('--segment_concurrency', type=int, default=8,
+                        help="Number of segments of one transcript to open-code at once")
+    parser.add_argument('--chunk_tokens', type=int, default=3000,
+                        help="Longest transcript text sent in one segmentation request; longer ones are chunked")
+    parser.add_argument('--batch', action='store_true',
+                        help="Run process-transcript through the OpenAI Batch API, resuming submitted batches")
+    parser.add_argument('--batch_poll_interval', type=int, default=60,
+                        help="Seconds between batch status checks")
+    parser.add_argument('--rerun_from', choices=STAGES, default=None,
+                        help="Recompute this stage and the ones after it for every transcript, "
+                             "reusing checkpointed outputs of the earlier stages")
+    parser.add_argument('--no_cache', action='store_true',
+                        help="Ignore cached LLM responses (fresh responses are still cached)")
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help="Maximum size of the LLM response cache")
+    parser.add_argument('--cache_max_age_days', type=float, default=None,
+                        help="Ignore and evict cached LLM responses older than this")
+    parser.add_argument('--prometheus_textfile', type=str, default=None,
+                        help="Where to write run metrics in Prometheus text format "
+                             "(default ./processed-transcripts/metrics/transcript_pipeline.prom)")
+    parser.add_argument('--export_workers', type=int, default=None,
+                        help="Processes used by json_to_csv to read stage outputs (default: CPU count)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only export stage outputs that are new, changed or deleted since the last json_to_csv")
+    parser.add_argument('--export_format', choices=['csv', 'parquet'], default='csv',
+                        help="Write json_to_csv tables as CSV, or as Parquet under ./processed-transcripts/parquet "
+                             "(needs pyarrow)")
+    parser.add_argument('--export_from', choices=['json', 'database'], default='json',
+                        help="Build the CSVs from the stage output files or from ./processed-transcripts/outputs.sqlite3 "
+                             "(filled by process-transcript and import-processed)")
+    parser.add_argument('--raw_storage', choices=['files', 'segments'], default='files',
+                        help="Keep scraped items as ./raw/<source>/<id>.json files or in the compressed segment "
+                             "store under ./raw/store (see import-raw and compact-raw)")
+    parser.add_argument('--openai_rpm', type=int, default=500, help="OpenAI requests per minute budget")
+    parser.add_argument('--openai_tpm', type=int, default=200000, help="OpenAI tokens per minute budget")
+    parser.add_argument('--openai_max_retries', type=int, default=6,
+                        help="Retries of an OpenAI request after rate-limit, timeout or server errors")
+    parser.add_argument('--openai_max_concurrency', type=int, default=64,
+                        help="Upper bound for the adaptive number of OpenAI requests in flight")
     args = parser.parse_args()
+    if args.batch and args.rerun_from:
+        parser.error("--rerun_from is not supported together with --batch")
+    if args.export_format == 'parquet' and args.incremental:
+        parser.error("--incremental is only supported for CSV exports")
+    if args.export_from == 'database' and (args.incremental or args.export_format == 'parquet'):
+        parser.error("--export_from database only supports full CSV exports")
 
     configs = load_env()
     app_configs = get_configs(configs)
@@ -158,7 +422,16 @@ def main():
         process_transcript_action(args, openai_key)
 
     elif args.action == 'json_to_csv':
-        json_to_csv_action()
+        json_to_csv_action(args)
+
+    elif args.action == 'import-raw':
+        import_raw_action(args)
+
+    elif args.action == 'compact-raw':
+        compact_raw_action(args)
+
+    elif args.action == 'import-processed':
+        import_processed_action(args)
 
 
 if __name__ == '__main__':
@@ -30,6 +30,8 @@ class SegmentSchema(BaseModel):
     title: str
     content: str
     main_idea: str
+    start_time: Optional[str] = None
+    end_time: Optional[str] = None
 
     def __dir__(self):
         return self.model_dump()
@@ -143,8 +145,21 @@ class AffinityMappingSchema(BaseModel):
         return self.model_dump_json()
 
 
+class RefinementSchema(BaseModel):
+    aspect: str
+    original: str
+    refined: str
+    rationale: str
+
+    def __dir__(self):
+        return self.model_dump()
+
+    def __json__(self):
+        return self.model_dump_json()
+
+
 class ValidationAndRefinementSchema(BaseModel):
-    refinements: Optional[List[Dict[str, Any]]] = None
+    refinements: List[RefinementSchema]
     key_findings: str
     insights: str
     recommendations: str
@@ -0,0 +1,164 @@
+import os
+import typing
+from typing import List, Optional
+
+from loguru import logger
+
+from json_to_csv import FILES_PER_TASK, TABLES, flattened_batches, list_stage_files
+from models import (AffinityMappingSchema, ClusterSchema, ExcerptSchema, PersonaSchema, RefinementSchema,
+                    SegmentCodingSchema, SegmentSchema, ThemeSchema, ValidationAndRefinementSchema)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_DIRECTORY = "./processed-transcripts/parquet"
+
+# Columns repeated across many rows, stored as dictionary indexes into their distinct values.
+DICTIONARY_COLUMNS = ('id', 'source', 'theme_name')
+COMPRESSION = 'zstd'
+# Rows are buffered per table and written in row groups of about this size.
+ROW_GROUP_ROWS = 64 * 1024
+
+# The model field each table column comes from, which its Arrow type is derived
+# from; a third element of True means the column holds one item of a list field.
+# Columns not listed here are strings.
+COLUMN_FIELDS = {
+    'segment_transcript': {
+        'segment_topic': (SegmentSchema, 'title'),
+        'segment_start_time': (SegmentSchema, 'start_time'),
+        'segment_end_time': (SegmentSchema, 'end_time'),
+        'segment_content': (SegmentSchema, 'content'),
+        'segment_main_idea': (SegmentSchema, 'main_idea'),
+    },
+    'open_coding': {
+        'segment': (SegmentCodingSchema, 'segment'),
+        'excerpt': (ExcerptSchema, 'text'),
+        'code': (ExcerptSchema, 'code'),
+    },
+    'themes': {
+        'theme_name': (ThemeSchema, 'theme_name'),
+        'cluster_name': (ClusterSchema, 'cluster_name'),
+        # One row per code of a cluster.
+        'code': (ClusterSchema, 'codes', True),
+    },
+    'affinity_map': {
+        'relationships': (AffinityMappingSchema, 'relationships'),
+    },
+    'user_personas': dict({'persona_name': (PersonaSchema, 'name')},
+                          **{field: (PersonaSchema, field) for field in PersonaSchema.model_fields if field != 'name'}),
+    'findings': {field: (ValidationAndRefinementSchema, field)
+                 for field in ('key_findings', 'insights', 'recommendations')},
+    'refinements': {field: (RefinementSchema, field) for field in RefinementSchema.model_fields},
+}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The parquet export needs pyarrow, install it with `pip install pyarrow`")
+
+
+def arrow_type(annotation):
+    """Arrow type of a model field annotation: str, int, float, bool, Optional and List of those."""
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union:
+        # Optional[X] is Union[X, None]; every column is nullable anyway.
+        annotation = next(arg for arg in typing.get_args(annotation) if arg is not type(None))
+        return arrow_type(annotation)
+    if origin in (list, List):
+        return pa.list_(arrow_type(typing.get_args(annotation)[0]))
+    types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+    if annotation not in types:
+        raise TypeError(f"No Arrow type for field type {annotation}")
+    return types[annotation]
+
+
+def table_schema(table):
+    _require_pyarrow()
+    fields = []
+    for column in TABLES[table]['fields']:
+        if column == 'segment_index':
+            column_type = pa.int32()
+        elif column in COLUMN_FIELDS[table]:
+            model, field, *item = COLUMN_FIELDS[table][column]
+            annotation = model.model_fields[field].annotation
+            column_type = arrow_type(typing.get_args(annotation)[0] if item else annotation)
+        else:
+            column_type = pa.string()
+        if column in DICTIONARY_COLUMNS:
+            column_type = pa.dictionary(pa.int32(), column_type)
+        fields.append(pa.field(column, column_type))
+    return pa.schema(fields)
+
+
+def parquet_path(table):
+    return os.path.join(PARQUET_DIRECTORY, f'{table}.parquet')
+
+
+def export(tables=None, workers=None):
+    """Writes one zstd-compressed Parquet file per table in `tables` (all by default),
+    in the same single parallel pass over the stage outputs as the CSV export. List
+    fields stay list columns. Files are always rebuilt in full."""
+    _require_pyarrow()
+    tables = list(tables or TABLES)
+    stages = list(dict.fromkeys(TABLES[table]['stage'] for table in tables))
+    workers = workers or os.cpu_count() or 1
+    tasks = [(stage, files[start:start + FILES_PER_TASK])
+             for stage, files in ((stage, sorted(list_stage_files(stage))) for stage in stages)
+             for start in range(0, len(files), FILES_PER_TASK)]
+
+    os.makedirs(PARQUET_DIRECTORY, exist_ok=True)
+    schemas = {table: table_schema(table) for table in tables}
+    writers = {}
+    pending = {table: [] for table in tables}
+
+    def flush(table):
+        if pending[table]:
+            columns = list(zip(*pending[table]))
+            writers[table].write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(columns, schemas[table])],
+                schema=schemas[table]))
+            pending[table] = []
+
+    try:
+        for table in tables:
+            writers[table] = pq.ParquetWriter(f'{parquet_path(table)}.tmp', schemas[table],
+                                              compression=COMPRESSION, use_dictionary=list(DICTIONARY_COLUMNS))
+
+        for (stage, file_paths), (batch, _) in flattened_batches(tasks, workers):
+            for table, rows in batch.items():
+                if table in pending:
+                    pending[table].extend(rows)
+                    if len(pending[table]) >= ROW_GROUP_ROWS:
+                        flush(table)
+            logger.info(f"Exported {len(file_paths)} {stage} files")
+
+        for table in tables:
+            flush(table)
+            writers.pop(table).close()
+            os.replace(f'{parquet_path(table)}.tmp', parquet_path(table))
+
+    except IOError as e:
+        logger.critical(f"Failed to write Parquet file: {e}")
+    except Exception as e:
+        logger.critical(f"Unexpected error: {e}")
+    finally:
+        # Writers still open here belong to tables that were not completed.
+        for table, writer in writers.items():
+            writer.close()
+            if os.path.exists(f'{parquet_path(table)}.tmp'):
+                os.remove(f'{parquet_path(table)}.tmp')
+
+
+def read_table(table, columns: Optional[List[str]] = None, filters=None):
+    """Reads an exported table as a pyarrow Table. Only `columns` are read from disk
+    when given; `filters` are pyarrow.parquet filters such as [('source', '=', 'youtube')]."""
+    _require_pyarrow()
+    return pq.read_table(parquet_path(table), columns=columns, filters=filters)
+
+
+def json_to_parquet(workers=None):
+    export(workers=workers)
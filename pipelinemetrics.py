@@ -0,0 +1,182 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+# USD per token. Batch API requests are billed at half price.
+PRICING = {
+    'gpt-4o-mini-2024-07-18': {'prompt': 0.15 / 1e6, 'cached_prompt': 0.075 / 1e6, 'completion': 0.60 / 1e6},
+}
+BATCH_DISCOUNT = 0.5
+
+QUANTILES = (0.5, 0.95)
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile, None for an empty list."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0,
+                  batch: bool = False) -> float:
+    prices = PRICING.get(model)
+    if prices is None:
+        return 0.0
+    cost = ((prompt_tokens - cached_tokens) * prices['prompt'] + cached_tokens * prices['cached_prompt']
+            + completion_tokens * prices['completion'])
+    return cost * BATCH_DISCOUNT if batch else cost
+
+
+class PipelineMetrics:
+    """Collects one record per LLM call of a processing run and aggregates them per
+    stage. Calls answered by the response cache are counted but cost nothing."""
+
+    def __init__(self, directory: str = './processed-transcripts/metrics'):
+        self.directory = directory
+        self.started = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, raw_file: str, model: str, usage: Any = None, latency: float = None,
+               retries: int = 0, cache_hit: bool = False, error: str = None, batch: bool = False):
+        # usage is either the pydantic CompletionUsage of a response or its dict form.
+        if usage is not None and not isinstance(usage, dict):
+            usage = usage.model_dump()
+        usage = usage or {}
+        details = usage.get('prompt_tokens_details') or {}
+        prompt_tokens = 0 if cache_hit else usage.get('prompt_tokens') or 0
+        completion_tokens = 0 if cache_hit else usage.get('completion_tokens') or 0
+        cached_tokens = 0 if cache_hit else details.get('cached_tokens') or 0
+
+        record = {
+            'stage': stage or 'unknown',
+            'file': raw_file,
+            'model': model,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'cached_tokens': cached_tokens,
+            'latency': latency,
+            'retries': retries,
+            'cache_hit': cache_hit,
+            'batch': batch,
+            'error': error,
+            'cost': estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens, batch),
+        }
+        with self._lock:
+            self.records.append(record)
+
+    @staticmethod
+    def _aggregate(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        latencies = [record['latency'] for record in records
+                     if record['latency'] is not None and not record['cache_hit']]
+        summary = {
+            'calls': len(records),
+            'cache_hits': sum(record['cache_hit'] for record in records),
+            'errors': sum(record['error'] is not None for record in records),
+            'retries': sum(record['retries'] for record in records),
+            'prompt_tokens': sum(record['prompt_tokens'] for record in records),
+            'completion_tokens': sum(record['completion_tokens'] for record in records),
+            'cached_tokens': sum(record['cached_tokens'] for record in records),
+            'cost_usd': round(sum(record['cost'] for record in records), 6),
+            'latency_sum': round(sum(latencies), 3),
+            'latency_count': len(latencies),
+        }
+        for q in QUANTILES:
+            value = percentile(latencies, q)
+            summary[f'latency_p{int(q * 100)}'] = round(value, 3) if value is not None else None
+        return summary
+
+    def summary(self) -> Dict[str, Any]:
+        with self._lock:
+            records = list(self.records)
+        by_stage = defaultdict(list)
+        for record in records:
+            by_stage[record['stage']].append(record)
+
+        return {
+            'started': self.started,
+            'duration': round(time.time() - self.started, 3),
+            'files': len({record['file'] for record in records}),
+            'total': self._aggregate(records),
+            'stages': {stage: self._aggregate(stage_records) for stage, stage_records in by_stage.items()},
+        }
+
+    def write_report(self, summary: Dict[str, Any] = None) -> str:
+        summary = summary or self.summary()
+        started = time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started))
+        path = os.path.join(self.directory, f'run-{started}.json')
+        self._write(path, json.dumps(summary, indent=4))
+        return path
+
+    def write_prometheus(self, summary: Dict[str, Any] = None, path: str = None) -> str:
+        """Writes the run in the Prometheus text format, for the node_exporter textfile collector."""
+        summary = summary or self.summary()
+        path = path or os.path.join(self.directory, 'transcript_pipeline.prom')
+        counters = [
+            ('calls', 'transcript_llm_calls_total', 'LLM calls, including response cache hits'),
+            ('cache_hits', 'transcript_llm_cache_hits_total', 'LLM calls answered by the response cache'),
+            ('errors', 'transcript_llm_errors_total', 'LLM calls that failed'),
+            ('retries', 'transcript_llm_retries_total', 'Retried LLM requests'),
+            ('cost_usd', 'transcript_llm_cost_usd_total', 'Estimated LLM cost in USD'),
+        ]
+
+        lines = []
+        for key, name, help_text in counters:
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+            lines += [f'{name}{{stage="{stage}"}} {values[key]}' for stage, values in summary['stages'].items()]
+
+        name = 'transcript_llm_tokens_total'
+        lines += [f'# HELP {name} Tokens used by LLM calls', f'# TYPE {name} counter']
+        for stage, values in summary['stages'].items():
+            for kind in ('prompt', 'completion', 'cached'):
+                lines.append(f'{name}{{stage="{stage}",kind="{kind}"}} {values[f"{kind}_tokens"]}')
+
+        name = 'transcript_llm_latency_seconds'
+        lines += [f'# HELP {name} Latency of LLM calls', f'# TYPE {name} summary']
+        for stage, values in summary['stages'].items():
+            for q in QUANTILES:
+                value = values[f'latency_p{int(q * 100)}']
+                lines.append(f'{name}{{stage="{stage}",quantile="{q}"}} {"NaN" if value is None else value}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {values["latency_sum"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {values["latency_count"]}')
+
+        name = 'transcript_pipeline_last_run_timestamp_seconds'
+        lines += [f'# HELP {name} Start time of the last processing run', f'# TYPE {name} gauge',
+                  f'{name} {summary["started"]}']
+
+        self._write(path, '\n'.join(lines) + '\n')
+        return path
+
+    def export(self, prometheus_path: str = None):
+        """Logs the per-stage summary and writes the JSON report and Prometheus textfile."""
+        summary = self.summary()
+        if not summary['stages']:
+            return
+        for stage, values in summary['stages'].items():
+            latency = (f"p50 {values['latency_p50']}s, p95 {values['latency_p95']}s, "
+                       if values['latency_count'] else '')
+            logger.info(f"Stage {stage}: {values['calls']} calls ({values['cache_hits']} cached, "
+                        f"{values['errors']} failed, {values['retries']} retries), "
+                        f"{values['prompt_tokens']} prompt / {values['completion_tokens']} completion tokens, "
+                        f"{latency}${values['cost_usd']}")
+        try:
+            report = self.write_report(summary)
+            self.write_prometheus(summary, prometheus_path)
+            logger.info(f"Run metrics written to {report}")
+        except IOError as e:
+            logger.exception(f"An I/O error occurred while writing run metrics: {e}")
+
+    @staticmethod
+    def _write(path: str, text: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(text)
+        os.replace(f'{path}.tmp', path)
@@ -0,0 +1,275 @@
+import csv
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List
+
+from loguru import logger
+from pydantic import ValidationError
+
+from json_to_csv import CSV_DIRECTORY, JSON_DIRECTORY, MANIFEST_PATH, TABLES
+from models import (AffinityMappingSchema, CodingSchema, SegmentationSchema, ThematicAnalysisSchema,
+                    ValidationAndRefinementSchema)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    source TEXT NOT NULL, id TEXT NOT NULL, url TEXT,
+    PRIMARY KEY (source, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS segmentations (
+    source TEXT NOT NULL, id TEXT NOT NULL, summary TEXT,
+    PRIMARY KEY (source, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS segments (
+    source TEXT NOT NULL, id TEXT NOT NULL, segment_index INTEGER NOT NULL,
+    title TEXT, content TEXT, main_idea TEXT, start_time TEXT, end_time TEXT,
+    PRIMARY KEY (source, id, segment_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS excerpts (
+    source TEXT NOT NULL, id TEXT NOT NULL, segment_index INTEGER NOT NULL, coding_index INTEGER NOT NULL,
+    excerpt_index INTEGER NOT NULL, segment TEXT, text TEXT, code TEXT,
+    PRIMARY KEY (source, id, segment_index, coding_index, excerpt_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS codes (
+    source TEXT NOT NULL, id TEXT NOT NULL, segment_index INTEGER NOT NULL, code TEXT NOT NULL,
+    PRIMARY KEY (source, id, segment_index, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS themes (
+    source TEXT NOT NULL, id TEXT NOT NULL, theme_index INTEGER NOT NULL, theme_name TEXT,
+    PRIMARY KEY (source, id, theme_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS clusters (
+    source TEXT NOT NULL, id TEXT NOT NULL, theme_index INTEGER NOT NULL, cluster_index INTEGER NOT NULL,
+    cluster_name TEXT,
+    PRIMARY KEY (source, id, theme_index, cluster_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS cluster_codes (
+    source TEXT NOT NULL, id TEXT NOT NULL, theme_index INTEGER NOT NULL, cluster_index INTEGER NOT NULL,
+    code_index INTEGER NOT NULL, code TEXT,
+    PRIMARY KEY (source, id, theme_index, cluster_index, code_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS affinity_maps (
+    source TEXT NOT NULL, id TEXT NOT NULL, relationships TEXT,
+    PRIMARY KEY (source, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS personas (
+    source TEXT NOT NULL, id TEXT NOT NULL, persona_index INTEGER NOT NULL, name TEXT, background TEXT,
+    goals TEXT, motivations TEXT, needs TEXT, challenges TEXT, behaviors TEXT, attitudes TEXT,
+    PRIMARY KEY (source, id, persona_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS persona_quotes (
+    source TEXT NOT NULL, id TEXT NOT NULL, persona_index INTEGER NOT NULL, quote_index INTEGER NOT NULL,
+    quote TEXT,
+    PRIMARY KEY (source, id, persona_index, quote_index)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS findings (
+    source TEXT NOT NULL, id TEXT NOT NULL, key_findings TEXT, insights TEXT, recommendations TEXT,
+    PRIMARY KEY (source, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS refinements (
+    source TEXT NOT NULL, id TEXT NOT NULL, refinement_index INTEGER NOT NULL, aspect TEXT, original TEXT,
+    refined TEXT, rationale TEXT,
+    PRIMARY KEY (source, id, refinement_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS documents_id ON documents (id);
+CREATE INDEX IF NOT EXISTS excerpts_code ON excerpts (code);
+CREATE INDEX IF NOT EXISTS codes_code ON codes (code);
+CREATE INDEX IF NOT EXISTS cluster_codes_code ON cluster_codes (code);
+CREATE INDEX IF NOT EXISTS themes_theme_name ON themes (theme_name);
+"""
+
+# The tables a stage output is stored in, all keyed by (source, id) first.
+STAGE_TABLES = {
+    'segment_transcript': ('segmentations', 'segments'),
+    'open_coding': ('excerpts', 'codes'),
+    'clustering_and_thematic_analysis': ('themes', 'clusters', 'cluster_codes'),
+    'affinity_mapping_and_persona_development': ('affinity_maps', 'personas', 'persona_quotes'),
+    'validate_and_document': ('findings', 'refinements'),
+}
+
+# The json_to_csv tables as queries over the normalized tables, with the CSV columns in order.
+EXPORT_QUERIES = {
+    'segment_transcript': """
+        SELECT d.id, d.source, d.url, s.segment_index, s.title, s.start_time, s.end_time, s.content, s.main_idea
+        FROM segments s JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id, s.segment_index""",
+    'open_coding': """
+        SELECT d.id, d.source, d.url, e.segment_index, e.segment, e.text, e.code
+        FROM excerpts e JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id, e.segment_index, e.coding_index, e.excerpt_index""",
+    'themes': """
+        SELECT d.id, d.source, d.url, t.theme_name, c.cluster_name, cc.code
+        FROM cluster_codes cc
+        JOIN clusters c USING (source, id, theme_index, cluster_index)
+        JOIN themes t USING (source, id, theme_index)
+        JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id, cc.theme_index, cc.cluster_index, cc.code_index""",
+    'affinity_map': """
+        SELECT d.id, d.source, d.url, a.relationships
+        FROM affinity_maps a JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id""",
+    'user_personas': """
+        SELECT d.id, d.source, d.url, p.name, p.background, p.goals, p.motivations, p.needs, p.challenges,
+               p.behaviors, p.attitudes,
+               (SELECT group_concat(quote, ', ') FROM (
+                    SELECT q.quote FROM persona_quotes q
+                    WHERE q.source = p.source AND q.id = p.id AND q.persona_index = p.persona_index
+                    ORDER BY q.quote_index))
+        FROM personas p JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id, p.persona_index""",
+    'findings': """
+        SELECT d.id, d.source, d.url, f.key_findings, f.insights, f.recommendations
+        FROM findings f JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id""",
+    'refinements': """
+        SELECT d.id, d.source, d.url, r.aspect, r.original, r.refined, r.rationale
+        FROM refinements r JOIN documents d USING (source, id)
+        ORDER BY d.source, d.id, r.refinement_index""",
+}
+
+
+class ProcessedStore:
+    """Normalized SQLite copy of the stage outputs under processed-transcripts/json,
+    one set of tables per stage following the models.py schemas.
+
+    Saving a stage output for a (source, id) replaces whatever that stage stored for
+    it before. The JSON files stay the source of truth for checkpoints and reruns.
+    """
+
+    def __init__(self, path: str = './processed-transcripts/outputs.sqlite3'):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(SCHEMA)
+
+    def save_stage(self, step: str, source: str, item_id: str, data: Any, url: str = None):
+        """Stores a stage output; raises pydantic's ValidationError if it does not match the stage schema."""
+        rows = self._rows(step, source, item_id, data)
+        with self._lock, self._conn:
+            self._conn.execute('INSERT INTO documents (source, id, url) VALUES (?, ?, ?) '
+                               'ON CONFLICT (source, id) DO UPDATE SET url = coalesce(excluded.url, url)',
+                               (source, item_id, url))
+            for table in STAGE_TABLES[step]:
+                self._conn.execute(f'DELETE FROM {table} WHERE source = ? AND id = ?', (source, item_id))
+            for table, table_rows in rows.items():
+                if table_rows:
+                    placeholders = ', '.join('?' * len(table_rows[0]))
+                    self._conn.executemany(f'INSERT INTO {table} VALUES ({placeholders})', table_rows)
+
+    @staticmethod
+    def _rows(step: str, source: str, item_id: str, data: Any) -> Dict[str, List[tuple]]:
+        key = (source, item_id)
+        rows = {table: [] for table in STAGE_TABLES[step]}
+
+        if step == 'segment_transcript':
+            segmentation = SegmentationSchema.model_validate(data)
+            rows['segmentations'].append(key + (segmentation.summary,))
+            rows['segments'] = [key + (index, segment.title, segment.content, segment.main_idea,
+                                       segment.start_time, segment.end_time)
+                                for index, segment in enumerate(segmentation.segments)]
+
+        elif step == 'open_coding':
+            # One CodingSchema per transcript segment, in segment order.
+            for segment_index, item in enumerate(data):
+                coding = CodingSchema.model_validate(item)
+                rows['excerpts'] += [key + (segment_index, coding_index, excerpt_index, segment.segment,
+                                            excerpt.text, excerpt.code)
+                                     for coding_index, segment in enumerate(coding.segments)
+                                     for excerpt_index, excerpt in enumerate(segment.excerpts)]
+                rows['codes'] += [key + (segment_index, code) for code in dict.fromkeys(coding.all_codes)]
+
+        elif step == 'clustering_and_thematic_analysis':
+            analysis = ThematicAnalysisSchema.model_validate(data)
+            for theme_index, theme in enumerate(analysis.themes):
+                rows['themes'].append(key + (theme_index, theme.theme_name))
+                for cluster_index, cluster in enumerate(theme.clusters):
+                    rows['clusters'].append(key + (theme_index, cluster_index, cluster.cluster_name))
+                    rows['cluster_codes'] += [key + (theme_index, cluster_index, code_index, code)
+                                              for code_index, code in enumerate(cluster.codes)]
+
+        elif step == 'affinity_mapping_and_persona_development':
+            mapping = AffinityMappingSchema.model_validate(data)
+            rows['affinity_maps'].append(key + (mapping.relationships,))
+            for persona_index, persona in enumerate(mapping.personas):
+                rows['personas'].append(key + (persona_index, persona.name, persona.background, persona.goals,
+                                               persona.motivations, persona.needs, persona.challenges,
+                                               persona.behaviors, persona.attitudes))
+                rows['persona_quotes'] += [key + (persona_index, quote_index, quote)
+                                           for quote_index, quote in enumerate(persona.relevant_quotes)]
+
+        elif step == 'validate_and_document':
+            validation = ValidationAndRefinementSchema.model_validate(data)
+            rows['findings'].append(key + (validation.key_findings, validation.insights,
+                                           validation.recommendations))
+            rows['refinements'] = [key + (index, refinement.aspect, refinement.original, refinement.refined,
+                                          refinement.rationale)
+                                   for index, refinement in enumerate(validation.refinements)]
+        return rows
+
+    def query(self, sql: str, parameters=()) -> List[Dict[str, Any]]:
+        with self._lock:
+            cursor = self._conn.execute(sql, parameters)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def excerpts_by_code(self, code: str) -> List[Dict[str, Any]]:
+        """Every excerpt coded `code` across the corpus, with the transcript it came from."""
+        return self.query('SELECT d.source, d.id, d.url, e.segment_index, e.segment, e.text FROM excerpts e '
+                          'JOIN documents d USING (source, id) WHERE e.code = ? '
+                          'ORDER BY d.source, d.id, e.segment_index', (code,))
+
+    def import_json(self, directory: str = JSON_DIRECTORY) -> int:
+        """Loads the stage outputs already saved as `<step>/<source>-<id>.json` files."""
+        imported = 0
+        for step in STAGE_TABLES:
+            step_directory = os.path.join(directory, step)
+            if not os.path.isdir(step_directory):
+                continue
+            for entry in os.scandir(step_directory):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path, 'r') as f:
+                        data = json.load(f)
+                    # Outputs are annotated with their id, source and url; open coding per segment.
+                    annotated = data[0] if isinstance(data, list) and data else data
+                    if not isinstance(annotated, dict) or not annotated.get('id') or not annotated.get('source'):
+                        logger.error(f"Skipping {entry.path}: it has no id and source")
+                        continue
+                    self.save_stage(step, annotated['source'], annotated['id'], data, annotated.get('url'))
+                    imported += 1
+                except (IOError, json.JSONDecodeError) as e:
+                    logger.error(f"Skipping unreadable file {entry.path}: {e}")
+                except ValidationError as e:
+                    logger.error(f"File {entry.path} does not match the {step} schema: {e}")
+        logger.info(f"Imported {imported} stage outputs from {directory} into {self.path}")
+        return imported
+
+    def export_csv(self, tables=None):
+        """Writes the json_to_csv tables from the database instead of the JSON files.
+
+        The export manifest describes CSVs built from the JSON files, so it is removed
+        and the next incremental json_to_csv rebuilds the tables in full.
+        """
+        if os.path.exists(MANIFEST_PATH):
+            os.remove(MANIFEST_PATH)
+        for table in tables or TABLES:
+            path = os.path.join(CSV_DIRECTORY, TABLES[table]['csv'])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                with self._lock, open(f'{path}.tmp', mode='w', newline='', encoding='utf-8') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(TABLES[table]['fields'])
+                    writer.writerows(self._conn.execute(EXPORT_QUERIES[table]))
+                os.replace(f'{path}.tmp', path)
+                logger.info(f"Exported {table} from {self.path} to {path}")
+            except IOError as e:
+                logger.critical(f"Failed to write CSV file: {e}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import random
+import threading
+import time
+
+from loguru import logger
+
+# Quota units charged per request. The YouTube Data API bills by endpoint; the
+# other sources are plain request counts.
+ENDPOINT_COSTS = {
+    'youtube.search.list': 100,
+    'youtube.videos.list': 1,
+    'youtube.commentThreads.list': 1,
+    'reddit.search': 1,
+    'reddit.info': 1,
+    'reddit.comments': 1,
+    'twitter.search': 1,
+    'g2.reviews': 1,
+}
+
+QUOTA_REASONS = {'quotaExceeded', 'dailyLimitExceeded'}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+
+class QuotaExhaustedError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.max_rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """Takes `tokens` (the bucket may go into debt) and returns how long the
+        caller has to wait before it is allowed to use them."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate, self.paused_until - now)
+
+    def wait_time(self, tokens=1):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return max(0.0, (tokens - self.tokens) / self.rate, self.paused_until - now)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def refund(self, tokens):
+        """Gives back tokens that were reserved but not used."""
+        if tokens <= 0:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def slow_down(self, factor=0.5, floor=0.1):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.max_rate * floor, self.rate * factor)
+
+    def speed_up(self, step=0.05):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate * step)
+
+
+def classify_error(error):
+    """Returns ('quota' | 'rate' | 'transient', retry_after) for errors worth
+    reacting to, or None. Works on googleapiclient HttpError (`resp`), requests /
+    prawcore exceptions (`response`) and twikit's TooManyRequests without importing them."""
+    if hasattr(error, 'rate_limit_reset'):
+        # twikit only passes the response headers, parsed into the reset timestamp.
+        reset = error.rate_limit_reset
+        return 'rate', max(1.0, reset - time.time()) if reset else None
+
+    response = getattr(error, 'resp', None)
+    if response is None:
+        response = getattr(error, 'response', None)
+    if response is None:
+        return None
+
+    status = getattr(response, 'status', None)
+    if status is None:
+        status = getattr(response, 'status_code', None)
+    headers = response if hasattr(response, 'get') else getattr(response, 'headers', {})
+    retry_after = headers.get('retry-after') or headers.get('Retry-After')
+    try:
+        retry_after = float(retry_after) if retry_after is not None else None
+    except ValueError:
+        retry_after = None
+
+    reasons = set()
+    content = getattr(error, 'content', None)
+    if content:
+        try:
+            details = json.loads(content).get('error', {})
+            reasons = {item.get('reason') for item in details.get('errors', [])}
+        except (ValueError, AttributeError):
+            pass
+
+    if reasons & QUOTA_REASONS:
+        return 'quota', retry_after
+    if status == 429 or reasons & RATE_LIMIT_REASONS:
+        return 'rate', retry_after
+    if status is not None and int(status) >= 500:
+        return 'transient', retry_after
+    return None
+
+
+def backoff(attempt, retry_after=None, base_delay=1.0, max_delay=60.0):
+    """The server's retry-after plus a little jitter, or exponential backoff with full jitter."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry_delay(error, decision, attempt, retries, description, on_rate=None, base_delay=1.0, max_delay=60.0):
+    """Returns the delay before retrying a request that failed with `error`, given
+    its classification (see classify_error), or raises when it should not be
+    retried: unclassified errors and the last attempt re-raise the error, quota
+    errors raise QuotaExhaustedError. `on_rate(delay)` is called on rate limits."""
+    if decision is None or attempt >= retries:
+        raise error
+
+    kind, retry_after = decision
+    if kind == 'quota':
+        raise QuotaExhaustedError(f"{description}: quota exhausted") from error
+
+    delay = backoff(attempt, retry_after, base_delay, max_delay)
+    if kind == 'rate' and on_rate is not None:
+        on_rate(delay)
+    logger.warning(f"{description} failed with a {kind} error, retrying in {delay:.1f}s "
+                   f"(attempt {attempt + 1}/{retries}): {error}")
+    return delay
+
+
+class SourceBudget:
+    """Request rate and quota shared by every query scraping the same source.
+
+    `calls`/`period` is a token bucket on requests, `quota` a second bucket on
+    quota units (see ENDPOINT_COSTS) that refills over `quota_period`. A request
+    whose quota would take longer than `max_quota_wait` to become available
+    raises QuotaExhaustedError instead of sleeping for hours.
+    """
+
+    def __init__(self, name, calls, period, quota=None, quota_period=86400, max_quota_wait=300, retries=3):
+        self.name = name
+        self.requests = TokenBucket(calls / period, calls)
+        self.units = TokenBucket(quota / quota_period, quota) if quota else None
+        self.max_quota_wait = max_quota_wait
+        self.retries = retries
+        self.exhausted = False
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self, endpoint, count):
+        if self.exhausted:
+            raise QuotaExhaustedError(f"{self.name} quota exhausted")
+
+        units = ENDPOINT_COSTS.get(endpoint, 1) * count
+        unit_wait = 0.0
+        if self.units is not None:
+            if self.units.wait_time(units) > self.max_quota_wait:
+                raise QuotaExhaustedError(f"{self.name} quota exhausted, {endpoint} needs {units} units")
+            unit_wait = self.units.reserve(units)
+
+        with self._lock:
+            self.used += units
+        return max(self.requests.reserve(count), unit_wait)
+
+    def acquire(self, endpoint, count=1):
+        wait = self._reserve(endpoint, count)
+        if wait > 0:
+            logger.debug(f"Rate budget for {self.name} exhausted, sleeping {wait:.2f}s before {endpoint}")
+            time.sleep(wait)
+
+    async def acquire_async(self, endpoint, count=1):
+        wait = self._reserve(endpoint, count)
+        if wait > 0:
+            logger.debug(f"Rate budget for {self.name} exhausted, sleeping {wait:.2f}s before {endpoint}")
+            await asyncio.sleep(wait)
+
+    def _on_rate_limit(self, delay):
+        self.requests.slow_down()
+        self.requests.pause(delay)
+
+    def _on_error(self, endpoint, error, attempt):
+        """Returns the delay before retrying, or re-raises when the error should not be retried."""
+        try:
+            return retry_delay(error, classify_error(error), attempt, self.retries, f"{self.name} {endpoint}",
+                               self._on_rate_limit)
+        except QuotaExhaustedError:
+            self.exhausted = True
+            raise
+
+    def call(self, endpoint, request, *args, count=1, **kwargs):
+        """Runs `request(*args, **kwargs)` once the budget allows it, backing off and
+        retrying on rate-limit and transient errors."""
+        attempt = 0
+        while True:
+            self.acquire(endpoint, count)
+            try:
+                result = request(*args, **kwargs)
+                self.requests.speed_up()
+                return result
+            except QuotaExhaustedError:
+                raise
+            except Exception as e:
+                time.sleep(self._on_error(endpoint, e, attempt))
+                attempt += 1
+
+    async def call_async(self, endpoint, request, *args, count=1, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire_async(endpoint, count)
+            try:
+                result = await request(*args, **kwargs)
+                self.requests.speed_up()
+                return result
+            except QuotaExhaustedError:
+                raise
+            except Exception as e:
+                await asyncio.sleep(self._on_error(endpoint, e, attempt))
+                attempt += 1
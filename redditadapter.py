@@ -1,48 +1,80 @@
 import json
+import math
 import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from ratelimit import limits, sleep_and_retry
+from ratelimiter import SourceBudget
+from seenindex import SeenIndex
 import praw
+from praw.models import MoreComments
 from prawcore.exceptions import PrawcoreException
 from scraperadapter import ScraperAdapter
 from loguru import logger
 
 
 class RedditAdapter(ScraperAdapter):
-    def __init__(self, client_id, client_secret, user_agent, threshold_criteria=None):
-        self.reddit = praw.Reddit(client_id=client_id, client_secret=client_secret, user_agent=user_agent)
-        self.scraped_posts = os.listdir('./raw/reddit/')
+    def __init__(self, client_id, client_secret, user_agent, threshold_criteria=None, budget=None, seen_index=None,
+                 comment_depth=3, comment_limit=100, replace_more_limit=0, comment_workers=4, raw_store=None):
+        self.credentials = {'client_id': client_id, 'client_secret': client_secret, 'user_agent': user_agent}
+        self.seen_index = seen_index or SeenIndex()
+        self.seen_index.load('reddit', './raw/reddit/')
         self.threshold_criteria = threshold_criteria
+        self.budget = budget or SourceBudget('reddit', calls=60, period=60)
+        self.comment_depth = comment_depth
+        self.comment_limit = comment_limit
+        self.replace_more_limit = replace_more_limit
+        self.comment_workers = comment_workers
+        self.raw_store = raw_store
+        self._local = threading.local()
+        self._comment_pool = None
+        self._pool_lock = threading.Lock()
+
+    def _thread_reddit(self):
+        # PRAW instances are not thread safe, so every query thread and comment worker gets its own.
+        if not hasattr(self._local, 'reddit'):
+            # A new instance fetches its own OAuth token on first use.
+            self.budget.acquire('reddit.auth')
+            self._local.reddit = praw.Reddit(**self.credentials)
+        return self._local.reddit
+
+    def _get_comment_pool(self):
+        # One pool for the adapter's lifetime, so its workers' PRAW instances (and their
+        # tokens) are reused across queries.
+        with self._pool_lock:
+            if self._comment_pool is None:
+                self._comment_pool = ThreadPoolExecutor(max_workers=self.comment_workers,
+                                                        thread_name_prefix='reddit-comments')
+            return self._comment_pool
 
-    @sleep_and_retry
-    @limits(calls=60, period=60)
     def scrape(self, query, max_results=100):
+        scraped_posts = []
         try:
-            for submission in self.reddit.subreddit("all").search(query, limit=max_results):
-                if f'{submission.id}.json' in self.scraped_posts:
-                    continue
-
-                if self.threshold_criteria is not None:
-                    if not self.threshold_criteria(submission):
-                        continue
+            # Search listings come back hydrated, 100 submissions per request, so the
+            # only per-submission request left is its comment tree.
+            results = self.budget.call('reddit.search', self._search, query, max_results,
+                                       count=max(1, math.ceil(max_results / 100)))
+            submissions = [
+                submission for submission in results
+                if not self.seen_index.contains('reddit', submission.id, self.raw_exists)
+                and (self.threshold_criteria is None or self.threshold_criteria(submission))
+            ]
 
+            comment_trees = self._get_comment_pool().map(self.get_comments,
+                                                         [submission.id for submission in submissions])
+            for submission, comments in zip(submissions, comment_trees):
                 post = {
                     'title': submission.title,
                     'text': submission.selftext,
                     'score': submission.score,
                     'num_comments': submission.num_comments,
-                    'comments': [
-                        {
-                            "id": comment.id,
-                            "body": comment.body,
-                            "author": comment.author.name if comment.author else None
-                        }
-                        for comment in submission.comments
-                    ]
+                    'comments': comments
                 }
 
-                self.save_response(submission.id, post)
-                self.scraped_posts.append(f'{submission.id}.json')
+                if self.save_response(submission.id, post):
+                    self.seen_index.add('reddit', submission.id)
+                    scraped_posts.append(f'{submission.id}.json')
         except PrawcoreException as e:
             logger.exception(f'An error occurred with Reddit API: {e}')
         except Exception as e:
@@ -50,18 +82,74 @@ class RedditAdapter(ScraperAdapter):
         else:
             logger.info('Scraping completed successfully.')
         finally:
-            return self.scraped_posts
+            return scraped_posts
+
+    def _search(self, query, max_results):
+        # The listing is lazy; reading it here makes its requests happen inside budget.call.
+        return list(self._thread_reddit().subreddit("all").search(query, limit=max_results))
+
+    def _comment_forest(self, submission_id):
+        submission = self._thread_reddit().submission(id=submission_id)
+        submission.comment_limit = self.comment_limit
+        # Accessing the comments fetches the submission.
+        return submission.comments
+
+    def get_comments(self, submission_id):
+        """Loads up to comment_limit comments no deeper than comment_depth, expanding
+        at most replace_more_limit "load more comments" stubs."""
+        comments = []
+        try:
+            forest = self.budget.call('reddit.comments', self._comment_forest, submission_id)
+
+            more_count = sum(1 for comment in forest.list() if isinstance(comment, MoreComments))
+            if more_count and self.replace_more_limit:
+                self.budget.call('reddit.comments', forest.replace_more, limit=self.replace_more_limit,
+                                 count=min(more_count, self.replace_more_limit))
+            else:
+                # Without a limit this only drops the stubs, no request is made.
+                forest.replace_more(limit=0)
+
+            for comment in forest.list():
+                if comment.depth > self.comment_depth:
+                    continue
+                comments.append({
+                    "id": comment.id,
+                    "body": comment.body,
+                    "author": comment.author.name if comment.author else None,
+                    "depth": comment.depth
+                })
+        except PrawcoreException as e:
+            logger.exception(f'An error occurred with Reddit API while fetching comments for {submission_id}: {e}')
+        except Exception as e:
+            logger.exception(f'An unexpected error occurred while fetching comments for {submission_id}: {e}')
+        return comments
+
+    def close(self):
+        with self._pool_lock:
+            if self._comment_pool is not None:
+                self._comment_pool.shutdown(wait=True)
+                self._comment_pool = None
+
+    def raw_exists(self, item_id):
+        if self.raw_store is not None:
+            return self.raw_store.contains('reddit', item_id)
+        return os.path.exists(f'./raw/reddit/{item_id}.json')
 
-    @staticmethod
-    def save_response(post_id, data):
+    def save_response(self, post_id, data):
+        if self.raw_store is not None:
+            return self.raw_store.save('reddit', post_id, data)
         filename = f'./raw/reddit/{post_id}.json'
         try:
-            with open(filename, 'w') as f:
+            tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_filename, 'w') as f:
                 json.dump(data, f, indent=4)
+            os.replace(tmp_filename, filename)
             logger.info(f'Data has been successfully written to {filename}')
+            return True
         except IOError as e:
             logger.exception(f'An I/O error occurred while writing the file: {e}')
         except json.JSONDecodeError as e:
             logger.exception(f'An error occurred while encoding JSON: {e}')
         except Exception as e:
             logger.exception(f'An unexpected error occurred: {e}')
+        return False
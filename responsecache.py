@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from loguru import logger
+
+CACHE_KEY_FIELDS = ('model', 'messages', 'temperature', 'max_tokens', 'response_format')
+
+
+def _schema_default(o):
+    # Structured output formats may be pydantic model classes rather than dicts.
+    if hasattr(o, 'model_json_schema'):
+        return {'name': o.__name__, 'schema': o.model_json_schema()}
+    return str(o)
+
+
+class ResponseCache:
+    """Content-addressed store of LLM responses, one JSON file per request hash.
+
+    Entries older than `max_age` seconds are ignored and removed on read; when the
+    cache grows past `max_bytes` the least recently used entries are deleted.
+    With `bypass` set, lookups always miss but fresh responses are still stored.
+    """
+
+    def __init__(self, directory: str = './processed-transcripts/cache', max_bytes: Optional[int] = None,
+                 max_age: Optional[float] = None, bypass: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in self._entries())
+
+    @staticmethod
+    def key(params: Dict[str, Any]) -> str:
+        payload = json.dumps({field: params.get(field) for field in CACHE_KEY_FIELDS},
+                             sort_keys=True, default=_schema_default)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+
+    def _entries(self):
+        for shard in os.scandir(self.directory):
+            if shard.is_dir():
+                yield from (entry for entry in os.scandir(shard.path) if entry.name.endswith('.json'))
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        if self.bypass or not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        if self.max_age is not None and time.time() - os.path.getmtime(path) > self.max_age:
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logger.warning(f"Discarding unreadable cache entry {path}: {e}")
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # Reads refresh the mtime, which is what size-based eviction orders by.
+        os.utime(path)
+        self.hits += 1
+        return data
+
+    def put(self, key: str, data: Dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+        except IOError as e:
+            logger.warning(f"Could not write cache entry {path}: {e}")
+            return
+
+        with self._lock:
+            self.size += os.path.getsize(path) - previous
+            over_budget = self.max_bytes is not None and self.size > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def delete(self, key: str):
+        """Drops the entry of a key, e.g. a response that turned out to be unusable."""
+        self._remove(self._path(key))
+
+    def _remove(self, path: str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.size -= size
+
+    def evict(self):
+        """Deletes least recently used entries until the cache is at 90% of max_bytes."""
+        target = self.max_bytes * 0.9
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        removed = 0
+        for entry in entries:
+            if self.size <= target:
+                break
+            self._remove(entry.path)
+            removed += 1
+        logger.info(f"Evicted {removed} response cache entries, cache size is now {self.size} bytes")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'size_bytes': self.size,
+        }
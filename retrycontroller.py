@@ -0,0 +1,159 @@
+import asyncio
+import re
+import time
+from typing import Any, Mapping, Optional
+
+from loguru import logger
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from ratelimiter import backoff, classify_error, retry_delay
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in an OpenAI reset header such as '1s', '6m0s' or '20ms'."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def classify_openai_error(error: Exception):
+    """Returns ('quota' | 'rate' | 'transient', retry_after) for errors worth
+    retrying or reacting to, or None for errors that will fail again."""
+    if isinstance(error, (APITimeoutError, APIConnectionError)):
+        return 'transient', None
+
+    if isinstance(error, APIStatusError) and error.status_code in (408, 409):
+        return 'transient', None
+
+    decision = classify_error(error)
+    if decision is None:
+        return None
+
+    kind, retry_after = decision
+    if isinstance(error, APIStatusError):
+        retry_after_ms = _header(error.response.headers, 'retry-after-ms')
+        if retry_after_ms is not None:
+            retry_after = retry_after_ms / 1000
+        # A 429 is also what OpenAI returns once the account is out of credit.
+        if kind == 'rate' and isinstance(error.body, dict) and error.body.get('code') == 'insufficient_quota':
+            return 'quota', retry_after
+    return kind, retry_after
+
+
+class AIMDController:
+    """Limits the number of OpenAI requests in flight.
+
+    The limit grows by one for every `limit` successful requests and halves on a
+    rate-limit error or when the `x-ratelimit-remaining-*` headers show less than
+    `low_watermark` of either limit left (at most once per `cooldown` seconds).
+    In the latter case new requests are also held back until the window resets.
+    """
+
+    def __init__(self, initial: int = 8, minimum: int = 1, maximum: int = 64, low_watermark: float = 0.05,
+                 cooldown: float = 5.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.low_watermark = low_watermark
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self._condition = None
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Created on first use, inside the event loop that runs the requests.
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        wait = self.paused_until - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_decrease < self.cooldown:
+            return
+        self.last_decrease = now
+        previous = self.limit
+        self.limit = max(float(self.minimum), self.limit / 2)
+        logger.info(f"Reducing OpenAI concurrency from {int(previous)} to {int(self.limit)}: {reason}")
+
+    def increase(self):
+        self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+    def on_response(self, headers: Mapping[str, str]):
+        resets = []
+        for kind in ('requests', 'tokens'):
+            remaining = _header(headers, f'x-ratelimit-remaining-{kind}')
+            limit = _header(headers, f'x-ratelimit-limit-{kind}')
+            if remaining is not None and limit and remaining / limit < self.low_watermark:
+                resets.append(parse_duration(headers.get(f'x-ratelimit-reset-{kind}')) or 0.0)
+
+        if resets:
+            self.decrease('rate limit window nearly used up')
+            self.pause(max(resets))
+        else:
+            self.increase()
+
+
+class RetryController:
+    """Decides whether a failed OpenAI request is retried and how long to wait.
+
+    Rate-limit and transient errors are retried up to `max_retries` times with
+    exponential backoff and full jitter, or after the server's retry-after when it
+    sends one. Rate-limit errors also halve the concurrency of `controller`.
+    """
+
+    def __init__(self, controller: AIMDController, max_retries: int = 6, base_delay: float = 1.0,
+                 max_delay: float = 60.0):
+        self.controller = controller
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        return backoff(attempt, retry_after, self.base_delay, self.max_delay)
+
+    def _on_rate_limit(self, delay: float):
+        self.controller.decrease('rate limited')
+        self.controller.pause(delay)
+
+    def on_error(self, error: Exception, attempt: int, context: Any = None) -> float:
+        """Returns the delay before retrying, or re-raises when the error should not be retried."""
+        return retry_delay(error, classify_openai_error(error), attempt, self.max_retries,
+                           f"OpenAI request{f' for {context}' if context else ''}", self._on_rate_limit,
+                           self.base_delay, self.max_delay)
@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+
+from loguru import logger
+
+
+class SeenIndex:
+    """Persistent set of (source, item_id) pairs that have already been saved.
+
+    Lookups go to an in-memory set per source; additions are written through to
+    SQLite in WAL mode so several scraper processes can share one index file.
+    """
+
+    def __init__(self, path='./raw/seen-index.sqlite3'):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.RLock()
+        self._seen = {}
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS seen ('
+                'source TEXT NOT NULL, item_id TEXT NOT NULL, PRIMARY KEY (source, item_id)'
+                ') WITHOUT ROWID'
+            )
+            self._conn.execute('CREATE TABLE IF NOT EXISTS bootstrapped (source TEXT PRIMARY KEY)')
+
+    def load(self, source, directory=None):
+        """Loads the ids of a source into memory. The first time a source is seen,
+        the existing `<id>.json` files in `directory` are imported into the index."""
+        with self._lock:
+            if source in self._seen:
+                return self._seen[source]
+
+            if directory is not None:
+                self._bootstrap(source, directory)
+
+            rows = self._conn.execute('SELECT item_id FROM seen WHERE source = ?', (source,))
+            self._seen[source] = {row[0] for row in rows}
+            logger.info(f'Loaded {len(self._seen[source])} seen ids for {source}')
+            return self._seen[source]
+
+    def _bootstrap(self, source, directory):
+        with self._conn:
+            if self._conn.execute('SELECT 1 FROM bootstrapped WHERE source = ?', (source,)).fetchone():
+                return
+
+            ids = []
+            if os.path.isdir(directory):
+                ids = [(source, entry.name[:-len('.json')]) for entry in os.scandir(directory)
+                       if entry.name.endswith('.json')]
+            self._conn.executemany('INSERT OR IGNORE INTO seen (source, item_id) VALUES (?, ?)', ids)
+            self._conn.execute('INSERT INTO bootstrapped (source) VALUES (?)', (source,))
+        logger.info(f'Imported {len(ids)} existing ids for {source} from {directory}')
+
+    def contains(self, source, item_id, exists=None):
+        """Whether an id was saved. With `exists`, a callable checking that the saved
+        item is still there, an id whose item was deleted is forgotten so that it is
+        saved again."""
+        item_id = str(item_id)
+        with self._lock:
+            if item_id not in self.load(source):
+                return False
+        if exists is None or exists(item_id):
+            return True
+        self.discard(source, item_id)
+        return False
+
+    def discard(self, source, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            with self._conn:
+                self._conn.execute('DELETE FROM seen WHERE source = ? AND item_id = ?', (source, item_id))
+            self.load(source).discard(item_id)
+
+    def add(self, source, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            with self._conn:
+                self._conn.execute('INSERT OR IGNORE INTO seen (source, item_id) VALUES (?, ?)', (source, item_id))
+            self.load(source).add(item_id)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
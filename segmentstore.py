@@ -0,0 +1,274 @@
+import gzip
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+
+class SegmentStore:
+    """Append-only store of raw scraped items, an alternative to one `<id>.json` file per item.
+
+    Items are appended to per-source segment files under `directory/<source>/`, each
+    record its own gzip member holding `<id>\\t<compact JSON>\\n`, so a segment is
+    also a valid .jsonl.gz file. A segment is closed once it reaches `segment_bytes`.
+    The offset and length of the latest record of every id are kept in a SQLite
+    index (WAL mode, like the SeenIndex), which random access and iteration go
+    through; records that were overwritten stay in their segment until compact().
+
+    Every process appends to segments of its own, so several scrapers can share a store.
+    """
+
+    def __init__(self, directory: str = './raw/store', segment_bytes: int = 64 * 1024 * 1024,
+                 compresslevel: int = 6):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compresslevel = compresslevel
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._active = {}
+        self._sequence = max([int(name.split('-')[0]) for source in os.listdir(directory)
+                              if os.path.isdir(os.path.join(directory, source))
+                              for name in self._segments(source)] or [0])
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.sqlite3'), timeout=30,
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'source TEXT NOT NULL, item_id TEXT NOT NULL, segment TEXT NOT NULL, '
+                'offset INTEGER NOT NULL, length INTEGER NOT NULL, PRIMARY KEY (source, item_id)'
+                ') WITHOUT ROWID'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS records_segment ON records (source, segment, offset)')
+
+    def _segment_path(self, source: str, segment: str) -> str:
+        return os.path.join(self.directory, source, segment)
+
+    def _segments(self, source: str) -> List[str]:
+        directory = os.path.join(self.directory, source)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(name for name in os.listdir(directory) if name.endswith('.jsonl.gz'))
+
+    def _writer(self, source: str):
+        file = self._active.get(source)
+        if file is not None and file.tell() < self.segment_bytes:
+            return file
+        if file is not None:
+            file.close()
+        # Named by a nanosecond timestamp that only moves forward, so name order is
+        # write order; the pid keeps names of processes starting together apart.
+        self._sequence = max(time.time_ns(), self._sequence + 1)
+        segment = f"{self._sequence:020d}-{os.getpid()}.jsonl.gz"
+        os.makedirs(os.path.join(self.directory, source), exist_ok=True)
+        file = open(self._segment_path(source, segment), 'ab')
+        self._active[source] = file
+        return file
+
+    def _encode(self, item_id: str, data: Any) -> bytes:
+        if '\t' in item_id or '\n' in item_id:
+            raise ValueError(f"Item id {item_id!r} contains a tab or newline")
+        line = f"{item_id}\t{json.dumps(data, separators=(',', ':'))}\n"
+        return gzip.compress(line.encode('utf-8'), compresslevel=self.compresslevel, mtime=0)
+
+    def put(self, source: str, item_id: Any, data: Any):
+        """Appends a record, replacing any earlier record of the same id."""
+        item_id = str(item_id)
+        member = self._encode(item_id, data)
+        with self._lock:
+            file = self._writer(source)
+            offset = file.tell()
+            file.write(member)
+            file.flush()
+            with self._conn:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO records (source, item_id, segment, offset, length) VALUES (?, ?, ?, ?, ?)',
+                    (source, item_id, os.path.basename(file.name), offset, len(member)))
+
+    def save(self, source: str, item_id: Any, data: Any) -> bool:
+        """put() for the adapters' save_response: logs failures instead of raising."""
+        try:
+            self.put(source, item_id, data)
+            logger.info(f'Data has been successfully written to the {source} segment store as {item_id}')
+            return True
+        except (IOError, sqlite3.Error) as e:
+            logger.exception(f'An I/O error occurred while writing to the segment store: {e}')
+        except (TypeError, ValueError) as e:
+            logger.exception(f'An error occurred while encoding JSON: {e}')
+        return False
+
+    def _location(self, source: str, item_id: Any) -> Optional[Tuple[str, int, int]]:
+        with self._lock:
+            return self._conn.execute('SELECT segment, offset, length FROM records WHERE source = ? AND item_id = ?',
+                                      (source, str(item_id))).fetchone()
+
+    @staticmethod
+    def _decode(member: bytes) -> Tuple[str, str]:
+        item_id, _, text = gzip.decompress(member).decode('utf-8').partition('\t')
+        return item_id, text.rstrip('\n')
+
+    def contains(self, source: str, item_id: Any) -> bool:
+        return self._location(source, item_id) is not None
+
+    def read(self, source: str, item_id: Any) -> Optional[str]:
+        """The JSON text of an item, or None if the store does not have it."""
+        location = self._location(source, item_id)
+        if location is None:
+            return None
+        segment, offset, length = location
+        with open(self._segment_path(source, segment), 'rb') as file:
+            file.seek(offset)
+            return self._decode(file.read(length))[1]
+
+    def get(self, source: str, item_id: Any) -> Optional[Any]:
+        text = self.read(source, item_id)
+        return None if text is None else json.loads(text)
+
+    def ids(self, source: str) -> List[str]:
+        """Ids of a source in the order they were written."""
+        with self._lock:
+            rows = self._conn.execute('SELECT item_id FROM records WHERE source = ? ORDER BY segment, offset',
+                                      (source,)).fetchall()
+        return [row[0] for row in rows]
+
+    def iterate(self, source: str) -> Iterator[Tuple[str, Any]]:
+        """Yields (id, item) for the latest record of every id, reading the segments
+        sequentially instead of seeking per item."""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT segment, offset, length FROM records WHERE source = ? ORDER BY segment, offset',
+                (source,)).fetchall()
+
+        file = None
+        try:
+            for segment, offset, length in rows:
+                if file is None or file.name != self._segment_path(source, segment):
+                    if file is not None:
+                        file.close()
+                    file = open(self._segment_path(source, segment), 'rb')
+                if file.tell() != offset:
+                    file.seek(offset)
+                item_id, text = self._decode(file.read(length))
+                yield item_id, json.loads(text)
+        finally:
+            if file is not None:
+                file.close()
+
+    def _close_active(self, source: str):
+        file = self._active.pop(source, None)
+        if file is not None:
+            file.close()
+
+    def compact(self, source: str) -> Dict[str, int]:
+        """Rewrites the live records of a source into new segments and deletes the old
+        ones. Do not run it while another process is writing to the same source."""
+        with self._lock:
+            self._close_active(source)
+            old_segments = self._segments(source)
+            before = sum(os.path.getsize(self._segment_path(source, segment)) for segment in old_segments)
+            records = self._conn.execute(
+                'SELECT item_id, segment, offset, length FROM records WHERE source = ? ORDER BY segment, offset',
+                (source,)).fetchall()
+
+            moved = []
+            readers = {}
+            try:
+                for item_id, segment, offset, length in records:
+                    if segment not in readers:
+                        readers[segment] = open(self._segment_path(source, segment), 'rb')
+                    readers[segment].seek(offset)
+                    member = readers[segment].read(length)
+                    file = self._writer(source)
+                    moved.append((os.path.basename(file.name), file.tell(), length, source, item_id))
+                    file.write(member)
+                self._close_active(source)
+            finally:
+                for reader in readers.values():
+                    reader.close()
+
+            with self._conn:
+                self._conn.executemany('UPDATE records SET segment = ?, offset = ?, length = ? '
+                                       'WHERE source = ? AND item_id = ?', moved)
+            for segment in old_segments:
+                os.remove(self._segment_path(source, segment))
+
+        after = sum(os.path.getsize(self._segment_path(source, segment)) for segment in self._segments(source))
+        logger.info(f'Compacted {source}: {len(records)} records, {len(old_segments)} segments, '
+                    f'{before} -> {after} bytes')
+        return {'records': len(records), 'bytes_before': before, 'bytes_after': after}
+
+    @staticmethod
+    def _members(path: str) -> Iterator[Tuple[int, int, bytes]]:
+        """Yields (offset, length, member) for every complete gzip member of a segment."""
+        with open(path, 'rb') as file:
+            content = file.read()
+        offset = 0
+        while offset < len(content):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                decompressor.decompress(content[offset:])
+            except zlib.error:
+                logger.warning(f'Ignoring a corrupt record at offset {offset} of {path}')
+                return
+            if not decompressor.eof:
+                # A record cut short by a crash; nothing after it was written.
+                logger.warning(f'Ignoring an incomplete record at offset {offset} of {path}')
+                return
+            length = len(content) - offset - len(decompressor.unused_data)
+            yield offset, length, content[offset:offset + length]
+            offset += length
+
+    def rebuild_index(self, source: str) -> int:
+        """Recreates the index entries of a source by scanning its segments, for when the
+        index was lost or a process died between appending a record and indexing it."""
+        with self._lock:
+            self._close_active(source)
+            locations = {}
+            for segment in self._segments(source):
+                for offset, length, member in self._members(self._segment_path(source, segment)):
+                    item_id, _ = self._decode(member)
+                    locations[item_id] = (segment, offset, length)
+
+            with self._conn:
+                self._conn.execute('DELETE FROM records WHERE source = ?', (source,))
+                self._conn.executemany(
+                    'INSERT INTO records (source, item_id, segment, offset, length) VALUES (?, ?, ?, ?, ?)',
+                    [(source, item_id, *location) for item_id, location in locations.items()])
+        logger.info(f'Rebuilt the {source} segment index: {len(locations)} records')
+        return len(locations)
+
+    def import_directory(self, source: str, directory: str) -> int:
+        """Imports the `<id>.json` files of the per-file layout, skipping ids the store
+        already has. The files are left in place."""
+        imported = 0
+        if not os.path.isdir(directory):
+            logger.warning(f'Nothing to import for {source}: {directory} does not exist')
+            return imported
+
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not entry.name.endswith('.json'):
+                continue
+            item_id = entry.name[:-len('.json')]
+            if self.contains(source, item_id):
+                continue
+            try:
+                with open(entry.path, 'r') as f:
+                    data = json.load(f)
+            except (IOError, json.JSONDecodeError) as e:
+                logger.error(f'Skipping unreadable file {entry.path}: {e}')
+                continue
+            self.put(source, item_id, data)
+            imported += 1
+        logger.info(f'Imported {imported} {source} files from {directory}')
+        return imported
+
+    def close(self):
+        with self._lock:
+            for source in list(self._active):
+                self._close_active(source)
+            self._conn.close()
@@ -0,0 +1,188 @@
+import html
+import json
+import re
+from functools import lru_cache
+from typing import Any, Dict, List
+
+from loguru import logger
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Non-speech caption tags such as [Music], [Applause], (laughs) and music notes.
+BOILERPLATE = re.compile(
+    r'\[[^\]]{0,40}\]|\((?:music|applause|laughter|laughs|inaudible|silence|noise)[^)]{0,20}\)|[♪♫]+',
+    re.IGNORECASE)
+WHITESPACE = re.compile(r'\s+')
+SENTENCE_END = ('.', '?', '!')
+SENTENCE_SPLIT = re.compile(r'(?<=[.?!])\s+')
+
+
+def clean_caption(text: str) -> str:
+    text = html.unescape(text).replace('>>', ' ')
+    text = BOILERPLATE.sub(' ', text)
+    return WHITESPACE.sub(' ', text).strip()
+
+
+def timestamp(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+
+def overlap(previous: List[str], words: List[str], min_words: int = 3) -> int:
+    """Number of leading words of `words` that repeat the tail of `previous`.
+    Auto-generated captions often roll the last line of one entry into the next.
+
+    Shorter repeats are usually real speech ("I said no" / "no way"), so only an
+    overlap of at least `min_words` words, or a repeat of a whole caption of two or
+    more words, counts.
+    """
+    lowered = [word.lower() for word in words]
+    for size in range(min(len(previous), len(words)), 0, -1):
+        if size < min_words and not (size == len(words) and size >= 2):
+            continue
+        if [word.lower() for word in previous[-size:]] == lowered[:size]:
+            return size
+    return 0
+
+
+def merge_captions(entries: List[Dict[str, Any]], paragraph_words: int = 120, max_words: int = 200,
+                   pause: float = 4.0) -> List[str]:
+    """Merges caption entries into paragraphs prefixed with a [mm:ss] marker.
+
+    A paragraph ends at the first sentence end after `paragraph_words` words, at a
+    pause of more than `pause` seconds between captions, or at `max_words`.
+    """
+    paragraphs = []
+    words = []
+    # Kept across paragraph breaks so a repeat straddling one is still caught.
+    tail = []
+    start = None
+    end = 0.0
+
+    def flush():
+        if words:
+            paragraphs.append(f'[{timestamp(start)}] {" ".join(words)}')
+            words.clear()
+
+    for entry in entries:
+        caption = clean_caption(str(entry.get('text', '')))
+        if not caption:
+            continue
+
+        entry_start = float(entry.get('start', end))
+        if words and entry_start - end > pause:
+            flush()
+
+        new_words = caption.split()
+        new_words = new_words[overlap(tail, new_words):]
+        if new_words:
+            if not words:
+                start = entry_start
+            words.extend(new_words)
+            tail = (tail + new_words)[-20:]
+        end = entry_start + float(entry.get('duration', 0))
+
+        if len(words) >= max_words or (len(words) >= paragraph_words and words[-1].endswith(SENTENCE_END)):
+            flush()
+
+    flush()
+    return paragraphs
+
+
+def prepare_transcript(raw: str) -> str:
+    """Reduces a raw YouTube result file to its title and transcript text.
+
+    Videos without a transcript fall back to the description. Input that is not a
+    scraped result file is returned unchanged.
+    """
+    try:
+        data = json.loads(raw)
+    except json.JSONDecodeError:
+        return raw
+    if not isinstance(data, dict):
+        return raw
+
+    lines = [f"Title: {data['title']}"] if data.get('title') else []
+    transcript = data.get('transcript')
+    if isinstance(transcript, list) and transcript:
+        lines.extend(merge_captions(transcript))
+    elif data.get('description'):
+        lines.append(f"Description: {data['description']}")
+    return '\n\n'.join(lines)
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    # Cached, so the fallback is only reported once.
+    if tiktoken is None:
+        logger.warning("tiktoken is not installed, chunk sizes are estimated as characters / 4")
+        return None
+    try:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        # The encoding is downloaded on first use and may be unavailable offline.
+        logger.warning(f"Could not load the o200k_base encoding, chunk sizes are estimated as characters / 4: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Token count under the gpt-4o tokenizer, or a chars/4 estimate without tiktoken."""
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _pieces(paragraph: str, max_tokens: int) -> List[str]:
+    """Splits a paragraph that is too long for one chunk at sentences, then at words."""
+    if count_tokens(paragraph) <= max_tokens:
+        return [paragraph]
+
+    pieces = []
+    current = []
+    for unit in SENTENCE_SPLIT.split(paragraph):
+        units = [unit] if count_tokens(unit) <= max_tokens else unit.split()
+        for unit in units:
+            if current and count_tokens(' '.join(current + [unit])) > max_tokens:
+                pieces.append(' '.join(current))
+                current = []
+            current.append(unit)
+    if current:
+        pieces.append(' '.join(current))
+    return pieces
+
+
+def chunk_transcript(text: str, max_tokens: int = 3000, overlap_tokens: int = 200) -> List[str]:
+    """Splits text at paragraph boundaries into chunks of at most `max_tokens`.
+
+    Each chunk after the first starts with the trailing paragraphs of the previous
+    one, up to `overlap_tokens`, so segments crossing a boundary are seen whole.
+    """
+    if count_tokens(text) <= max_tokens:
+        return [text]
+
+    paragraphs = [(piece, count_tokens(piece))
+                  for paragraph in text.split('\n\n') if paragraph.strip()
+                  for piece in _pieces(paragraph, max_tokens)]
+    chunks = []
+    current = []
+    size = 0
+    for paragraph, tokens in paragraphs:
+        if current and size + tokens > max_tokens:
+            chunks.append('\n\n'.join(p for p, _ in current))
+            overlap = []
+            overlap_size = 0
+            for previous in reversed(current):
+                if overlap_size + previous[1] > overlap_tokens or overlap_size + previous[1] + tokens > max_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous[1]
+            current, size = overlap, overlap_size
+        current.append((paragraph, tokens))
+        size += tokens
+    chunks.append('\n\n'.join(p for p, _ in current))
+    return chunks
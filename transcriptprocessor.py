@@ -1,170 +1,509 @@
+import asyncio
+import hashlib
 import json
 import os
-from openai import OpenAI, OpenAIError
+import time
+from difflib import SequenceMatcher
+from openai import AsyncOpenAI, OpenAIError
+from openai.lib._parsing import type_to_response_format_param
+from openai.types.chat import ChatCompletion
 from loguru import logger
+from pydantic import ValidationError
 from typing import List, Dict, Any
 
 from models import *
+from pipelinemetrics import PipelineMetrics
+from processedstore import ProcessedStore
+from ratelimiter import TokenBucket
+from responsecache import ResponseCache
+from retrycontroller import AIMDController, RetryController
+from seenindex import SeenIndex
+from segmentstore import SegmentStore
+from transcriptpreprocessor import chunk_transcript, prepare_transcript
+
+
+STAGES = [
+    'segment_transcript',
+    'open_coding',
+    'clustering_and_thematic_analysis',
+    'affinity_mapping_and_persona_development',
+    'validate_and_document',
+]
+
+# Stage outputs each stage reads, in the order its method takes them; 'transcript'
+# is the raw transcript text.
+STAGE_DEPENDENCIES = {
+    'segment_transcript': ['transcript'],
+    'open_coding': ['segment_transcript'],
+    'clustering_and_thematic_analysis': ['open_coding'],
+    'affinity_mapping_and_persona_development': ['clustering_and_thematic_analysis'],
+    'validate_and_document': ['affinity_mapping_and_persona_development', 'clustering_and_thematic_analysis'],
+}
+
+STAGE_SCHEMAS = {
+    'segment_transcript': SegmentationSchema,
+    'open_coding': CodingSchema,
+    'clustering_and_thematic_analysis': ThematicAnalysisSchema,
+    'affinity_mapping_and_persona_development': AffinityMappingSchema,
+    'validate_and_document': ValidationAndRefinementSchema,
+}
+
+# How much of an invalid response is quoted back when asking for a repair.
+REPAIR_CONTEXT_CHARS = 8000
+
+# Strict json_schema response formats, so every stage output parses into its schema.
+STAGE_RESPONSE_FORMATS = {step: type_to_response_format_param(schema) for step, schema in STAGE_SCHEMAS.items()}
+
+PROMPTS = {
+    'segment_transcript': "You are a qualitative research expert. Please read the transcript and divide it into meaningful segments based on changes in topic, speaker, or activity. Give response in JSON.",
+    'open_coding': "You are a qualitative research expert. Identify significant words, phrases, or sentences in each segment that capture key ideas or concepts and assign initial codes. Give response in JSON.",
+    'clustering_and_thematic_analysis': "You are a qualitative research expert. Group similar or related codes together to form clusters and identify overarching themes. Give response in JSON.",
+    'affinity_mapping_and_persona_development': "You are a qualitative research expert. Using the identified themes, create an affinity map and develop user personas. Give response in JSON.",
+    'validate_and_document': "You are a qualitative research expert. Review the personas and themes to ensure they accurately reflect the data and context of the transcript. Give response in JSON.",
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def validation_hint(error: ValidationError, limit: int = 5) -> str:
+    problems = [f"{'.'.join(str(part) for part in item['loc']) or 'response'}: {item['msg']}"
+                for item in error.errors(include_url=False)[:limit]]
+    more = error.error_count() - limit
+    return '; '.join(problems) + (f' (and {more} more)' if more > 0 else '')
 
 
 class TranscriptProcessor:
-    def __init__(self, openai_api_key: str, transcript_source: str, raw_files: List[str]):
-        self.openai_client = OpenAI(api_key=openai_api_key)
+    def __init__(self, openai_api_key: str, transcript_source: str, raw_files: List[str],
+                 seen_index: SeenIndex = None, concurrency: int = 4, requests_per_minute: int = 500,
+                 tokens_per_minute: int = 200000, segment_concurrency: int = 8, cache: ResponseCache = None,
+                 rerun_from: str = None, chunk_tokens: int = 3000, chunk_overlap_tokens: int = 200,
+                 metrics: PipelineMetrics = None, prometheus_textfile: str = None, max_retries: int = 6,
+                 max_concurrent_requests: int = 64, repair_attempts: int = 2, raw_store: SegmentStore = None,
+                 processed_store: ProcessedStore = None):
+        # Retries are handled by self.retry, which also adapts concurrency to rate limits.
+        self.openai_client = AsyncOpenAI(api_key=openai_api_key, max_retries=0)
         self.transcript_source = transcript_source
         self.raw_files = raw_files
-        self.processed_transcripts = os.listdir('./processed-transcripts/json')
+        # Raw files are read from the segment store when one is given, as '<id>.json'.
+        self.raw_store = raw_store
+        # Stage outputs are also written to this database when given.
+        self.processed_store = processed_store
+        # Kept with the processed outputs, apart from the scrapers' index of raw items.
+        self.seen_index = seen_index or SeenIndex('./processed-transcripts/seen-index.sqlite3')
+        self.seen_index.load('processed-transcripts', './processed-transcripts/json')
         self.urls = {
             'youtube': 'https://www.youtube.com/watch?v={}'
         }
+        self.concurrency = concurrency
+        self.segment_concurrency = segment_concurrency
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.cache = cache
+        self.metrics = metrics or PipelineMetrics()
+        self.prometheus_textfile = prometheus_textfile
+        if rerun_from is not None and rerun_from not in STAGES:
+            raise ValueError(f"Unknown stage: {rerun_from}")
+        self.rerun_from = rerun_from
+        self.request_budget = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.token_budget = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.request_concurrency = AIMDController(
+            initial=min(max_concurrent_requests, concurrency * segment_concurrency), maximum=max_concurrent_requests)
+        self.retry = RetryController(self.request_concurrency, max_retries=max_retries)
+        self.repair_attempts = repair_attempts
 
     def process_transcripts(self):
-        logger.info(f"Starting transcript processing for source: {self.transcript_source}")
-        for raw_file in self.raw_files:
-            if f"{self.transcript_source}-{raw_file}" in self.processed_transcripts:
-                logger.info(f"Skipping already processed transcript: {raw_file}")
-                continue
+        asyncio.run(self.process_transcripts_async())
 
-            filepath = f"./raw/{self.transcript_source}/{raw_file}"
-            try:
-                with open(filepath, 'r') as file:
-                    transcript = file.read()
-                logger.info(f"Transcript read successfully from file: {raw_file}")
+    async def process_transcripts_async(self):
+        logger.info(f"Starting transcript processing for source: {self.transcript_source} "
+                    f"with concurrency: {self.concurrency}")
+        raw_files = iter(self.raw_files)
+
+        async def worker():
+            # Workers share one iterator, so at most `concurrency` files are in flight.
+            for raw_file in raw_files:
+                await self.process_transcript(raw_file)
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        if self.cache is not None:
+            logger.info(f"Response cache stats: {self.cache.stats()}")
+        self.metrics.export(self.prometheus_textfile)
+
+    async def process_transcript(self, raw_file: str):
+        # With rerun_from set, finished files go through the pipeline again; stages
+        # before rerun_from are still reused from their checkpoints.
+        if self.rerun_from is None and self.is_processed(raw_file):
+            logger.info(f"Skipping already processed transcript: {raw_file}")
+            return
 
-                analysis_result = self.analyze_transcript(transcript, raw_file)
-                self.save_response(raw_file, analysis_result)
+        try:
+            transcript = self.read_transcript(raw_file)
+            logger.info(f"Transcript read successfully from file: {raw_file}")
+
+            analysis_result = await self.analyze_transcript(transcript, raw_file)
+            if self.save_response(raw_file, analysis_result):
+                self.seen_index.add('processed-transcripts', self.processed_id(raw_file))
+
+            logger.info(
+                f"Transcript analysis complete for {raw_file}. Check processed-transcripts directory for the results.")
+        except (FileNotFoundError, IOError, OpenAIError, Exception) as e:
+            logger.exception(f"An error occurred while processing file {raw_file}: {e}")
+
+    def processed_id(self, raw_file: str) -> str:
+        return f"{self.transcript_source}-{raw_file.split('.')[0]}"
 
-                logger.info(
-                    f"Transcript analysis complete for {raw_file}. Check processed-transcripts directory for the results.")
-            except (FileNotFoundError, IOError, OpenAIError, Exception) as e:
-                logger.exception(f"An error occurred while processing file {raw_file}: {e}")
+    def is_processed(self, raw_file: str) -> bool:
+        """Whether the final output of a transcript exists; deleting it makes the
+        transcript be processed again."""
+        return self.seen_index.contains(
+            'processed-transcripts', self.processed_id(raw_file),
+            lambda _: os.path.exists(f'./processed-transcripts/json/{self.transcript_source}-{raw_file}'))
 
-    def analyze_transcript(self, transcript: str, raw_file: str) -> Dict[str, Any]:
+    def read_transcript(self, raw_file: str) -> str:
+        """Returns the compact transcript text that segmentation works on."""
+        if self.raw_store is not None:
+            raw = self.raw_store.read(self.transcript_source, raw_file.split('.')[0])
+            if raw is None:
+                raise FileNotFoundError(f"{raw_file} is not in the {self.transcript_source} segment store")
+        else:
+            with open(f"./raw/{self.transcript_source}/{raw_file}", 'r') as file:
+                raw = file.read()
+        transcript = prepare_transcript(raw)
+        logger.debug(f"Preprocessed {raw_file}: ~{estimate_tokens(raw)} -> ~{estimate_tokens(transcript)} tokens")
+        return transcript
+
+    async def analyze_transcript(self, transcript: str, raw_file: str) -> Dict[str, Any]:
         logger.info(f"Analyzing transcript: {raw_file}")
-        segments = self.segment_transcript(transcript, raw_file)
-        codes = self.open_coding(segments, raw_file)
-        clusters = self.clustering_and_thematic_analysis(codes, raw_file)
-        personas = self.affinity_mapping_and_persona_development(clusters, raw_file)
-        validated_data = self.validate_and_document(personas, clusters, raw_file)
-        return validated_data
+        checkpoints = self.load_checkpoints(raw_file)
+        outputs = {'transcript': transcript}
+
+        for step in STAGES:
+            inputs = [outputs[dependency] for dependency in STAGE_DEPENDENCIES[step]]
+            fingerprint = self.stage_fingerprint(step, self.stage_contents(step, *inputs))
+
+            output = self.reusable_output(raw_file, step, fingerprint, checkpoints)
+            if output is None:
+                output = await getattr(self, step)(*inputs, raw_file)
+            if checkpoints.get(step) != fingerprint:
+                checkpoints[step] = fingerprint
+                self.save_checkpoints(raw_file, checkpoints)
+            outputs[step] = output
 
-    def segment_transcript(self, transcript: str, raw_file: str) -> List[Dict[str, Any]]:
+        return outputs['validate_and_document']
+
+    def reusable_output(self, raw_file: str, step: str, fingerprint: str, checkpoints: Dict[str, str]) -> Any:
+        """Returns the saved output of a stage if it was produced from the same inputs,
+        prompt and request parameters, otherwise None."""
+        if self.rerun_from is not None and STAGES.index(step) >= STAGES.index(self.rerun_from):
+            return None
+        # Outputs saved before checkpoints existed (or by the batch runner) have no
+        # fingerprint yet and are adopted as they are.
+        if checkpoints.get(step, fingerprint) != fingerprint:
+            logger.info(f"Stage {step} is out of date for {raw_file}")
+            return None
+
+        output = self.load_response(raw_file, step)
+        if output is not None:
+            logger.info(f"Reusing {step} output for {raw_file}")
+        return output
+
+    def stage_contents(self, step: str, *inputs: Any) -> List[str]:
+        """User messages sent for a stage, given the outputs named in STAGE_DEPENDENCIES."""
+        if step == 'segment_transcript':
+            transcript, = inputs
+            return chunk_transcript(transcript, self.chunk_tokens, self.chunk_overlap_tokens)
+        if step == 'open_coding':
+            segments, = inputs
+            return [json.dumps(segment) for segment in segments['segments']]
+        if step == 'validate_and_document':
+            personas, clusters = inputs
+            return [json.dumps({"personas": personas, "clusters": clusters})]
+        if step in STAGE_DEPENDENCIES:
+            return [json.dumps(inputs[0])]
+        raise ValueError(f"Unknown stage: {step}")
+
+    def stage_fingerprint(self, step: str, contents: List[str]) -> str:
+        # The request hashes cover prompt, model and sampling parameters, so a change
+        # to any of them (or to an upstream output) invalidates the stage.
+        keys = [ResponseCache.key(self.stage_params(step, content)) for content in contents]
+        return hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+
+    async def segment_transcript(self, transcript: str, raw_file: str) -> List[Dict[str, Any]]:
         """Step 1: Familiarization and Segmentation"""
         logger.info(f"Segmenting transcript: {raw_file}")
-        messages = [
-            {"role": "system",
-             "content": "You are a qualitative research expert. Please read the transcript and divide it into meaningful segments based on changes in topic, speaker, or activity. Give response in JSON."},
-            {"role": "user", "content": transcript}
-        ]
-        response = self._api_call(messages)
+        semaphore = asyncio.Semaphore(self.segment_concurrency)
 
-        segments = json.loads(response.choices[0].message.content)
-        segments['id'] = raw_file.split(".")[0]
-        segments['source'] = self.transcript_source
-        segments['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
+        async def segment_chunk(content):
+            async with semaphore:
+                return await self.stage_call('segment_transcript', content, raw_file)
+
+        # Long transcripts are segmented chunk by chunk in parallel and merged back.
+        chunks = self.stage_contents('segment_transcript', transcript)
+        if len(chunks) > 1:
+            logger.info(f"Segmenting {raw_file} in {len(chunks)} chunks")
+        parts = await asyncio.gather(*(segment_chunk(content) for content in chunks))
+        segments = self.annotate(self.merge_segmentations(parts), raw_file)
 
         self.save_response(raw_file, segments, "segment_transcript")
         return segments
 
-    def open_coding(self, segments: List[Dict[str, Any]], raw_file: str) -> List[Dict[str, Any]]:
+    async def open_coding(self, segments: List[Dict[str, Any]], raw_file: str) -> List[Dict[str, Any]]:
         """Step 2: Open Coding"""
         logger.info(f"Open coding for segmented transcript: {raw_file}")
-        codes = []
-        for segment in segments['segments']:
-            messages = [
-                {"role": "system",
-                 "content": "You are a qualitative research expert. Identify significant words, phrases, or sentences in each segment that capture key ideas or concepts and assign initial codes. Give response in JSON."},
-                {"role": "user", "content": json.dumps(segment)}
-            ]
-            response = self._api_call(messages)
-            segment_codes = json.loads(response.choices[0].message.content)
-            segment_codes['id'] = raw_file.split(".")[0]
-            segment_codes['source'] = self.transcript_source
-            segment_codes['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
-            codes.append(segment_codes)
+        semaphore = asyncio.Semaphore(self.segment_concurrency)
+
+        async def code_segment(content):
+            async with semaphore:
+                return self.annotate(await self.stage_call('open_coding', content, raw_file), raw_file)
+
+        # gather returns results in argument order, so codes line up with the segments.
+        codes = list(await asyncio.gather(*(code_segment(content)
+                                           for content in self.stage_contents('open_coding', segments))))
 
         self.save_response(raw_file, codes, "open_coding")
         return codes
 
-    def clustering_and_thematic_analysis(self, codes: List[Dict[str, Any]], raw_file: str) -> List[Dict[str, Any]]:
+    async def clustering_and_thematic_analysis(self, codes: List[Dict[str, Any]], raw_file: str) -> List[Dict[str, Any]]:
         """Step 3: Clustering Codes and Thematic Analysis"""
         logger.info(f"Clustering and thematic analysis for coded transcript: {raw_file}")
-        messages = [
-            {"role": "system",
-             "content": "You are a qualitative research expert. Group similar or related codes together to form clusters and identify overarching themes. Give response in JSON."},
-            {"role": "user", "content": json.dumps(codes)}
-        ]
-        response = self._api_call(messages)
-        clusters = json.loads(response.choices[0].message.content)
-        clusters['id'] = raw_file.split(".")[0]
-        clusters['source'] = self.transcript_source
-        clusters['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
+        content, = self.stage_contents('clustering_and_thematic_analysis', codes)
+        clusters = self.annotate(await self.stage_call('clustering_and_thematic_analysis', content, raw_file), raw_file)
 
         self.save_response(raw_file, clusters, "clustering_and_thematic_analysis")
         return clusters
 
-    def affinity_mapping_and_persona_development(self, clusters: List[Dict[str, Any]], raw_file: str) -> List[
+    async def affinity_mapping_and_persona_development(self, clusters: List[Dict[str, Any]], raw_file: str) -> List[
         Dict[str, Any]]:
         logger.info(f"Affinity mapping and persona development for clustered transcript: {raw_file}")
-        messages = [
-            {"role": "system",
-             "content": "You are a qualitative research expert. Using the identified themes, create an affinity map and develop user personas. Give response in JSON."},
-            {"role": "user", "content": json.dumps(clusters)}
-        ]
-        response = self._api_call(messages)
-        personas = json.loads(response.choices[0].message.content)
-        personas['id'] = raw_file.split(".")[0]
-        personas['source'] = self.transcript_source
-        personas['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
+        content, = self.stage_contents('affinity_mapping_and_persona_development', clusters)
+        personas = self.annotate(await self.stage_call('affinity_mapping_and_persona_development', content, raw_file), raw_file)
 
         self.save_response(raw_file, personas, "affinity_mapping_and_persona_development")
         return personas
 
-    def validate_and_document(self, personas: List[Dict[str, Any]], clusters: List[Dict[str, Any]], raw_file: str) -> \
+    async def validate_and_document(self, personas: List[Dict[str, Any]], clusters: List[Dict[str, Any]], raw_file: str) -> \
     Dict[str, Any]:
         logger.info(f"Validation and documentation for transcript: {raw_file}")
-        messages = [
-            {"role": "system",
-             "content": "You are a qualitative research expert. Review the personas and themes to ensure they accurately reflect the data and context of the transcript. Give response in JSON."},
-            {"role": "user", "content": json.dumps({"personas": personas, "clusters": clusters})}
-        ]
-        response = self._api_call(messages)
-        validated_data = json.loads(response.choices[0].message.content)
-        validated_data['id'] = raw_file.split(".")[0]
-        validated_data['source'] = self.transcript_source
-        validated_data['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
+        content, = self.stage_contents('validate_and_document', personas, clusters)
+        validated_data = self.annotate(await self.stage_call('validate_and_document', content, raw_file), raw_file)
 
         self.save_response(raw_file, validated_data, "validate_and_document")
         return validated_data
 
-    def _api_call(self, messages: List[Dict[str, Any]], response_format=None) -> Dict[str, Any]:
+    async def stage_call(self, step: str, content: str, raw_file: str) -> Dict[str, Any]:
+        """Requests a stage output and validates it against the stage schema. An invalid
+        response is sent back once per repair attempt with what was wrong with it, so
+        only this request is repeated rather than the whole pipeline."""
+        schema = STAGE_SCHEMAS[step]
+        messages = self.stage_messages(step, content)
+        attempt = 0
+        while True:
+            response = await self._api_call(messages, step, raw_file, STAGE_RESPONSE_FORMATS[step])
+            choice = response.choices[0]
+            output = choice.message.content or ''
+            if choice.finish_reason == 'length':
+                # A truncated response must not be replayed from the cache, even if it parses.
+                self.uncache(messages, STAGE_RESPONSE_FORMATS[step])
+            try:
+                return schema.model_validate_json(output).model_dump()
+            except ValidationError as e:
+                self.uncache(messages, STAGE_RESPONSE_FORMATS[step])
+                if choice.finish_reason == 'length':
+                    hint = "the response was cut off at the token limit, keep every field shorter"
+                elif getattr(choice.message, 'refusal', None):
+                    hint = f"the request was refused: {choice.message.refusal}"
+                else:
+                    hint = validation_hint(e)
+                if attempt >= self.repair_attempts:
+                    raise ValueError(f"{step} output for {raw_file} does not match {schema.__name__}: {hint}") from e
+
+            attempt += 1
+            logger.warning(f"Repairing {step} output for {raw_file} (attempt {attempt}/{self.repair_attempts}): {hint}")
+            messages = self.stage_messages(step, content) + [
+                {"role": "assistant", "content": output[:REPAIR_CONTEXT_CHARS]},
+                {"role": "user", "content": f"That response does not match the {schema.__name__} schema: {hint}. "
+                                            f"Reply with the complete corrected JSON."},
+            ]
+
+    def uncache(self, messages: List[Dict[str, Any]], response_format=None, max_tokens: int = 10000):
+        """Removes the cached response of a request, so the next run asks the API again."""
+        if self.cache is not None:
+            self.cache.delete(self.cache.key(self.request_params(messages, response_format, max_tokens)))
+
+    @staticmethod
+    def merge_segmentations(parts: List[Dict[str, Any]], similarity: float = 0.8) -> Dict[str, Any]:
+        """Joins per-chunk segmentations in order. A segment repeating one of the last
+        segments kept (the chunks overlap) is dropped."""
+        if len(parts) == 1:
+            return parts[0]
+
+        segments = []
+        for part in parts:
+            for segment in part.get('segments', []):
+                content = str(segment.get('content', ''))
+                duplicate = any(
+                    str(kept.get('title', '')).strip().lower() == str(segment.get('title', '')).strip().lower()
+                    or SequenceMatcher(None, str(kept.get('content', '')), content).ratio() >= similarity
+                    for kept in segments[-3:])
+                if not duplicate:
+                    segments.append(segment)
+
+        summary = ' '.join(str(part['summary']) for part in parts if part.get('summary'))
+        return {'summary': summary, 'segments': segments}
+
+    @staticmethod
+    def stage_messages(step: str, content: str) -> List[Dict[str, Any]]:
+        return [
+            {"role": "system", "content": PROMPTS[step]},
+            {"role": "user", "content": content}
+        ]
+
+    def annotate(self, data: Dict[str, Any], raw_file: str) -> Dict[str, Any]:
+        data['id'] = raw_file.split(".")[0]
+        data['source'] = self.transcript_source
+        data['url'] = self.urls[self.transcript_source].format(raw_file.split(".")[0])
+        return data
+
+    @classmethod
+    def stage_params(cls, step: str, content: str) -> Dict[str, Any]:
+        return cls.request_params(cls.stage_messages(step, content), STAGE_RESPONSE_FORMATS[step])
+
+    @staticmethod
+    def request_params(messages: List[Dict[str, Any]], response_format=None, max_tokens: int = 10000) -> Dict[str, Any]:
+        return {
+            "model": "gpt-4o-mini-2024-07-18",
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0.5,
+            "response_format": {"type": "json_object"} if response_format is None else response_format,
+        }
+
+    async def _api_call(self, messages: List[Dict[str, Any]], stage: str = None, raw_file: str = None,
+                        response_format=None, max_tokens: int = 10000) -> Dict[str, Any]:
+        params = self.request_params(messages, response_format, max_tokens)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key(params)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f"Response cache hit for {cache_key}")
+                self.metrics.record(stage, raw_file, params['model'], cache_hit=True)
+                return ChatCompletion.model_validate(cached)
+
+        logger.debug(f"Sending API call with messages: {messages}")
+        # OpenAI counts prompt tokens plus max_tokens against the TPM limit when a
+        # request is admitted, so reserve the same amount here.
+        reserved = estimate_tokens(json.dumps(messages)) + max_tokens
+        attempt = 0
+        while True:
+            await self.request_budget.acquire_async()
+            await self.token_budget.acquire_async(reserved)
+            await self.request_concurrency.acquire()
+
+            # Latency covers the request itself, not the time spent waiting for budget.
+            started = time.monotonic()
+            try:
+                raw_response = await self.openai_client.chat.completions.with_raw_response.create(**params)
+                self.request_concurrency.on_response(raw_response.headers)
+                response = raw_response.parse()
+                break
+            except OpenAIError as e:
+                latency = time.monotonic() - started
+                try:
+                    delay = self.retry.on_error(e, attempt, f"{stage} of {raw_file}")
+                except Exception:
+                    self.metrics.record(stage, raw_file, params['model'], latency=latency, retries=attempt,
+                                        error=type(e).__name__)
+                    logger.exception(f"An error occurred with the OpenAI API: {e}")
+                    raise
+            finally:
+                await self.request_concurrency.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        logger.debug(f"Received API response: {response}")
+        if response.usage is not None:
+            # What the request actually used is known now; the rest of the reservation
+            # is credited back rather than holding the budget for the whole minute.
+            self.token_budget.refund(reserved - response.usage.total_tokens)
+        self.metrics.record(stage, raw_file, params['model'], response.usage, time.monotonic() - started,
+                            retries=attempt)
+        if cache_key is not None:
+            self.cache.put(cache_key, response.model_dump(mode='json'))
+        return response
+
+    def load_response(self, filename: str, step: str) -> Any:
+        """Returns a stage output saved by save_response, or None if it does not exist
+        or cannot be used (unreadable, or not matching the stage schema), so that it is
+        recomputed."""
+        filepath = f'./processed-transcripts/json/{step}/{self.transcript_source}-{filename}'
+        if not os.path.exists(filepath):
+            return None
         try:
-            logger.debug(f"Sending API call with messages: {messages}")
-            response_format = {"type": "json_object"} if response_format == None else response_format
-            response = self.openai_client.beta.chat.completions.parse(
-                model="gpt-4o-mini-2024-07-18",
-                messages=messages,
-                max_tokens=10000,
-                temperature=0.5,
-                response_format=response_format,
-            )
-            logger.debug(f"Received API response: {response}")
-            return response
-        except OpenAIError as e:
-            logger.exception(f"An error occurred with the OpenAI API: {e}")
-            raise e
-
-    def save_response(self, filename: str, data: Dict[str, Any], step: str = None):
+            with open(filepath, 'r') as f:
+                output = json.load(f)
+            # open_coding is saved as the list of per-segment outputs.
+            for item in output if step == 'open_coding' else [output]:
+                STAGE_SCHEMAS[step].model_validate(item)
+        except (IOError, json.JSONDecodeError, ValidationError) as e:
+            logger.warning(f"Ignoring unusable {step} output {filepath}: {e}")
+            return None
+        return output
+
+    def checkpoint_path(self, filename: str) -> str:
+        return f'./processed-transcripts/checkpoints/{self.transcript_source}-{filename}'
+
+    def load_checkpoints(self, filename: str) -> Dict[str, str]:
+        """Returns the fingerprint each stage output of a file was produced with."""
+        filepath = self.checkpoint_path(filename)
+        if not os.path.exists(filepath):
+            return {}
+        try:
+            with open(filepath, 'r') as f:
+                return json.load(f)
+        except (IOError, json.JSONDecodeError) as e:
+            logger.warning(f"Ignoring unreadable checkpoint manifest {filepath}: {e}")
+            return {}
+
+    def save_checkpoints(self, filename: str, checkpoints: Dict[str, str]):
+        filepath = self.checkpoint_path(filename)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(f'{filepath}.tmp', 'w') as f:
+            json.dump(checkpoints, f, indent=4)
+        os.replace(f'{filepath}.tmp', filepath)
+
+    def store_output(self, step: str, item_id: str, data: Any):
+        if self.processed_store is None:
+            return
+        try:
+            self.processed_store.save_stage(step, self.transcript_source, item_id, data,
+                                            self.urls[self.transcript_source].format(item_id))
+        except Exception as e:
+            # The JSON file is what later stages and exports read, so this is not fatal.
+            logger.exception(f'Could not store {step} output for {item_id} in the database: {e}')
+
+    def save_response(self, filename: str, data: Dict[str, Any], step: str = None) -> bool:
         filepath = f'./processed-transcripts/json/' if step is None else f'./processed-transcripts/json/{step}/'
         os.makedirs(filepath, exist_ok=True)
+        item_id = filename.split('.')[0]
         filename = f'{filepath}/{self.transcript_source}-{filename}'
 
         try:
-            with open(filename, 'w+') as f:
+            # Written to a temporary file first, so a crash never leaves a truncated output behind.
+            with open(f'{filename}.tmp', 'w') as f:
                 f.write(json.dumps(data, indent=4, default=lambda o: o.dict() if hasattr(o, 'dict') else str(o)))
+            os.replace(f'{filename}.tmp', filename)
             logger.info(f'Data has been successfully written to {filename}')
+            if step is not None:
+                self.store_output(step, item_id, data)
+            return True
         except IOError as e:
             logger.exception(f'An I/O error occurred while writing the file: {e}')
         except json.JSONDecodeError as e:
             logger.exception(f'An error occurred while encoding JSON: {e}')
         except Exception as e:
             logger.exception(f'An unexpected error occurred: {e}')
+        return False
@@ -1,61 +1,137 @@
+import asyncio
+import functools
 import json
 import os
+import uuid
 
-from ratelimit import limits, sleep_and_retry
 from twikit import Client
+from twikit.errors import Unauthorized
+from ratelimiter import SourceBudget
+from seenindex import SeenIndex
 
 class TwitterAdapter:
-    def __init__(self, auth_info, language='en-US', threshold_criteria=None):
+    def __init__(self, auth_info, language='en-US', threshold_criteria=None, budget=None, seen_index=None,
+                 cookies_file='./configs/twitter-cookies.json', product='Latest', page_size=20, raw_store=None):
         self.client = Client(language)
         self.auth_info = auth_info
-        self.scraped_tweets = os.listdir('./raw/twitter/')
+        self.seen_index = seen_index or SeenIndex()
+        self.seen_index.load('twitter', './raw/twitter/')
         self.threshold_criteria = threshold_criteria
+        self.budget = budget or SourceBudget('twitter', calls=50, period=900)
+        self.cookies_file = cookies_file
+        self.product = product
+        self.page_size = page_size
+        self.raw_store = raw_store
+        self.session_generation = 0
+        self._login_lock = None
+
+    async def ensure_session(self, expired_generation=None):
+        """Restores the saved session cookies, or logs in and saves them. Passing the
+        generation that failed with Unauthorized forces a fresh login, unless another
+        query has already replaced that session."""
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+
+        async with self._login_lock:
+            if expired_generation is None and self.session_generation:
+                return
+            if expired_generation is not None and expired_generation != self.session_generation:
+                return
+
+            if expired_generation is None and os.path.exists(self.cookies_file):
+                self.client.load_cookies(self.cookies_file)
+                print(f'Reusing Twitter session from {self.cookies_file}')
+            else:
+                await self.client.login(**self.auth_info)
+                self.client.save_cookies(self.cookies_file)
+                print(f'Logged in to Twitter and saved session to {self.cookies_file}')
+            self.session_generation += 1
+
+    async def search_page(self, query, cursor=None, retries=2):
+        """One page of search results. Rate limits are retried by the budget; `retries`
+        bounds the fresh logins after the session expires."""
+        for attempt in range(retries + 1):
+            await self.ensure_session()
+            generation = self.session_generation
+            try:
+                # A partial, since call_async takes `count` itself.
+                search = functools.partial(self.client.search_tweet, query, self.product,
+                                           count=self.page_size, cursor=cursor)
+                return await self.budget.call_async('twitter.search', search)
+            except Unauthorized:
+                if attempt == retries:
+                    raise
+                print('Twitter session expired, logging in again')
+                await self.ensure_session(expired_generation=generation)
 
     async def scrape(self, query, max_results=100):
         results = []
+        next_page = None
         try:
-            await self.client.login(**self.auth_info)
-            tweets = await self.client.search_tweet(query=query, max_results=max_results)
-            for tweet in tweets:
-                if f'{tweet["id"]}.json' in self.scraped_tweets:
-                    continue
-
-                if self.threshold_criteria is not None:
-                    if not self.threshold_criteria(tweet):
-                        continue
-
-                tweet_data = {
-                    'body': tweet['full_text'],
-                    'likes': tweet['favorite_count'],
-                    'retweets': tweet['retweet_count'],
-                    'user_info': {
-                        'username': tweet['user']['screen_name'],
-                        'followers_count': tweet['user']['followers_count'],
-                        'following_count': tweet['user']['friends_count']
-                    },
-                    'tweet_id': tweet['id']
-                }
-
-                self.save_response(tweet['id'], tweet_data)
-                self.scraped_tweets.append(f'{tweet["id"]}.json')
-
-                results.append(tweet_data)
+            page = await self.search_page(query)
+            while page is not None and len(page) and len(results) < max_results:
+                # Fetch the next page while this one is being filtered and written.
+                next_page = asyncio.create_task(self.search_page(query, page.next_cursor)) \
+                    if page.next_cursor else None
+
+                saved = await asyncio.gather(*(asyncio.to_thread(self.process_tweet, tweet) for tweet in page))
+                results.extend(tweet_data for tweet_data in saved if tweet_data is not None)
 
+                page = await next_page if next_page is not None else None
+                next_page = None
         except Exception as e:
             print(f'Error during scraping: {e}')
-        return results
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+        return results[:max_results]
+
+    def process_tweet(self, tweet):
+        if self.seen_index.contains('twitter', tweet.id, self.raw_exists):
+            return None
+
+        if self.threshold_criteria is not None:
+            if not self.threshold_criteria(tweet):
+                return None
+
+        tweet_data = {
+            'body': tweet.full_text,
+            'likes': tweet.favorite_count,
+            'retweets': tweet.retweet_count,
+            'user_info': {
+                'username': tweet.user.screen_name,
+                'followers_count': tweet.user.followers_count,
+                'following_count': tweet.user.following_count
+            },
+            'tweet_id': tweet.id
+        }
+
+        if self.save_response(tweet.id, tweet_data):
+            self.seen_index.add('twitter', tweet.id)
+            return tweet_data
+        return None
+
+    def raw_exists(self, item_id):
+        if self.raw_store is not None:
+            return self.raw_store.contains('twitter', item_id)
+        return os.path.exists(f'./raw/twitter/{item_id}.json')
 
-    @staticmethod
-    def save_response(tweet_id, data):
+    def save_response(self, tweet_id, data):
+        if self.raw_store is not None:
+            return self.raw_store.save('twitter', tweet_id, data)
         filename = f'./raw/twitter/{tweet_id}.json'
         try:
-            with open(filename, 'w') as f:
+            tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_filename, 'w') as f:
                 f.write(json.dumps(data, indent=4))
+            os.replace(tmp_filename, filename)
             print(f'Data has been successfully written to {filename}')
+            return True
         except IOError as e:
             print(f'An I/O error occurred while writing the file: {e}')
         except json.JSONDecodeError as e:
             print(f'An error occurred while encoding JSON: {e}')
         except Exception as e:
             print(f'An unexpected error occurred: {e}')
+        return False
 
@@ -1,84 +1,126 @@
 import json
 import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from youtube_transcript_api import YouTubeTranscriptApi, NoTranscriptFound, TranscriptsDisabled
-from ratelimit import limits, sleep_and_retry
+from ratelimiter import SourceBudget, classify_error
+from seenindex import SeenIndex
 from scraperadapter import ScraperAdapter
 from loguru import logger
 
 
 class YouTubeAdapter(ScraperAdapter):
-    def __init__(self, api_key, downloader, threshold_criteria=None):
-        self.youtube = build("youtube", "v3", developerKey=api_key)
-        self.scraped_videos = os.listdir('./raw/youtube/')
+    def __init__(self, api_key, downloader, threshold_criteria=None, budget=None, seen_index=None,
+                 transcript_workers=8, max_pending=32, raw_store=None):
+        self.api_key = api_key
+        self._local = threading.local()
+        self.seen_index = seen_index or SeenIndex()
+        self.seen_index.load('youtube', './raw/youtube/')
         self.downloader = downloader
         self.threshold_criteria = threshold_criteria
+        self.budget = budget or SourceBudget('youtube', calls=100, period=100)
+        self.transcript_workers = transcript_workers
+        self.max_pending = max_pending
+        self.raw_store = raw_store
+
+    @property
+    def youtube(self):
+        # The discovery client's httplib2 transport is not thread safe, so every thread
+        # scraping a query builds its own.
+        if not hasattr(self._local, 'youtube'):
+            self._local.youtube = build("youtube", "v3", developerKey=self.api_key)
+        return self._local.youtube
 
-    @sleep_and_retry
-    @limits(calls=100, period=100)
     def scrape(self, query, max_results=50):
-        videos = []
+        scraped_videos = []
+        pending = {}
+        submitted = 0
         next_page_token = None
 
-        while len(videos) < max_results:
-            try:
-                search_response = self.youtube.search().list(
-                    q=query,
-                    type="video",
-                    part="id,snippet",
-                    maxResults=min(50, max_results - len(videos)),
-                    pageToken=next_page_token
-                ).execute()
-
-                for item in search_response.get('items', []):
-                    video_id = item['id']['videoId']
-
-                    if f'{video_id}.json' in self.scraped_videos:
-                        continue
-
-                    video_info = self.youtube.videos().list(
-                        part="snippet,statistics",
-                        id=video_id
-                    ).execute()['items'][0]
-
-                    if self.threshold_criteria and not self.threshold_criteria(video_info):
-                        continue
-
-                    transcript = self.get_transcript(video_id)
-                    comments = self.get_comments(video_id)
-
-                    video_data = {
-                        'video_id': video_id,
-                        'title': video_info['snippet']['title'],
-                        'description': video_info['snippet']['description'],
-                        'channel': video_info['snippet']['channelTitle'],
-                        'likes': video_info['statistics'].get('likeCount', 0),
-                        'views': video_info['statistics'].get('viewCount', 0),
-                        'comments': comments,
-                        'transcript': transcript
-                    }
-
-                    self.save_response(video_id, video_data)
-                    self.scraped_videos.append(f'{video_id}.json')
-
-                    if self.downloader:
-                        self.downloader.fetch_audio(video_id)
-                    videos.append(video_data)
-
-                next_page_token = search_response.get('nextPageToken')
-                if not next_page_token:
+        # Search pagination, videos.list and the comment batch stay on this thread (it has
+        # its own discovery client); transcripts are fetched by the pool and
+        # written back here as they complete. At most max_pending videos are held in
+        # memory, so a slow transcript backend pauses pagination instead of piling up.
+        with ThreadPoolExecutor(max_workers=self.transcript_workers, thread_name_prefix='youtube-transcript') as pool:
+            while submitted < max_results:
+                try:
+                    search_response = self.budget.call('youtube.search.list', self.youtube.search().list(
+                        q=query,
+                        type="video",
+                        part="id,snippet",
+                        maxResults=min(50, max_results - submitted),
+                        pageToken=next_page_token
+                    ).execute)
+
+                    video_ids = [item['id']['videoId'] for item in search_response.get('items', [])]
+                    video_ids = [video_id for video_id in video_ids
+                                 if not self.seen_index.contains('youtube', video_id, self.raw_exists)]
+
+                    video_infos = self.get_video_info(video_ids)
+                    if self.threshold_criteria:
+                        video_infos = {video_id: video_info for video_id, video_info in video_infos.items()
+                                       if self.threshold_criteria(video_info)}
+                    page_comments = self.get_comments([video_id for video_id in video_ids if video_id in video_infos])
+
+                    for video_id in video_ids:
+                        video_info = video_infos.get(video_id)
+                        if video_info is None:
+                            continue
+
+                        if len(pending) >= self.max_pending:
+                            self._write_completed(pending, scraped_videos, FIRST_COMPLETED)
+
+                        future = pool.submit(self.get_transcript, video_id)
+                        pending[future] = (video_id, video_info, page_comments.get(video_id, []))
+                        submitted += 1
+
+                    next_page_token = search_response.get('nextPageToken')
+                    if not next_page_token:
+                        break
+
+                except HttpError as e:
+                    logger.exception(f"An HTTP error {e.resp.status} occurred: {e.content}")
+                    break
+                except Exception as e:
+                    logger.exception(f"An unexpected error occurred: {e}")
                     break
 
-            except HttpError as e:
-                logger.exception(f"An HTTP error {e.resp.status} occurred: {e.content}")
-                break
-            except Exception as e:
-                logger.exception(f"An unexpected error occurred: {e}")
-                break
+            self._write_completed(pending, scraped_videos, ALL_COMPLETED)
 
         logger.info('Scraping completed successfully.')
-        return self.scraped_videos
+        return scraped_videos
+
+    def _write_completed(self, pending, scraped_videos, return_when):
+        if not pending:
+            return
+
+        done, _ = wait(pending, return_when=return_when)
+        for future in done:
+            video_id, video_info, comments = pending.pop(future)
+            video_data = {
+                'video_id': video_id,
+                'title': video_info['snippet']['title'],
+                'description': video_info['snippet']['description'],
+                'channel': video_info['snippet']['channelTitle'],
+                'likes': video_info['statistics'].get('likeCount', 0),
+                'views': video_info['statistics'].get('viewCount', 0),
+                'comments': comments,
+                'transcript': future.result()
+            }
+
+            if self.save_response(video_id, video_data):
+                self.seen_index.add('youtube', video_id)
+                scraped_videos.append(f'{video_id}.json')
+
+            if self.downloader:
+                self.downloader.enqueue(video_id)
+
+    def close(self):
+        if self.downloader:
+            self.downloader.close()
 
     def get_transcript(self, video_id):
         transcript = []
@@ -98,39 +140,92 @@ class YouTubeAdapter(ScraperAdapter):
 
         return transcript
 
-    def get_comments(self, video_id, max_comments=5):
-        comments = []
-        try:
-            comments_response = self.youtube.commentThreads().list(
-                part="snippet",
-                videoId=video_id,
-                maxResults=max_comments
-            ).execute()
-
-            for comment_item in comments_response.get('items', []):
+    def get_video_info(self, video_ids):
+        """Fetches snippet and statistics for up to 50 videos in a single videos.list call."""
+        if not video_ids:
+            return {}
+
+        response = self.budget.call('youtube.videos.list', self.youtube.videos().list(
+            part="snippet,statistics",
+            id=','.join(video_ids)
+        ).execute)
+        return {item['id']: item for item in response.get('items', [])}
+
+    def get_comments(self, video_ids, max_comments=5):
+        """Fetches top-level comments for several videos in one batched HTTP request."""
+        comments = {video_id: [] for video_id in video_ids}
+        if not video_ids:
+            return comments
+        remaining = list(video_ids)
+        failed = {}
+
+        def handle_response(video_id, response, exception):
+            if exception is not None:
+                if classify_error(exception) is not None:
+                    # Rate-limit, quota and server errors are retried once the batch is done.
+                    failed[video_id] = exception
+                elif isinstance(exception, HttpError):
+                    logger.warning(f"An HTTP error {exception.resp.status} occurred while fetching comments "
+                                   f"for {video_id}: {exception.content}")
+                else:
+                    logger.error(f"An unexpected error occurred while fetching comments for {video_id}: {exception}")
+                return
+
+            for comment_item in response.get('items', []):
                 top_comment = comment_item['snippet']['topLevelComment']['snippet']
-                comments.append({
+                comments[video_id].append({
                     'author': top_comment['authorDisplayName'],
                     'text': top_comment['textDisplay'],
                     'likeCount': top_comment['likeCount']
                 })
 
+        def execute():
+            failed.clear()
+            batch = self.youtube.new_batch_http_request(callback=handle_response)
+            for video_id in remaining:
+                batch.add(self.youtube.commentThreads().list(
+                    part="snippet",
+                    videoId=video_id,
+                    maxResults=max_comments
+                ), request_id=video_id)
+            batch.execute()
+            if failed:
+                # Raising the error of a failed request lets the budget back off before
+                # the failed requests are sent again as a smaller batch.
+                remaining[:] = list(failed)
+                raise next(iter(failed.values()))
+
+        try:
+            # One round trip, but every commentThreads.list inside the batch is billed.
+            self.budget.call('youtube.commentThreads.list', execute, count=len(video_ids))
         except HttpError as e:
-            logger.exception(f"An HTTP error {e.resp.status} occurred while fetching comments: {e.content}")
+            logger.exception(f"An HTTP error {e.resp.status} occurred while fetching comments for "
+                             f"{', '.join(remaining)}: {e.content}")
         except Exception as e:
             logger.exception(f"An unexpected error occurred while fetching comments: {e}")
 
         return comments
 
+    def raw_exists(self, item_id):
+        if self.raw_store is not None:
+            return self.raw_store.contains('youtube', item_id)
+        return os.path.exists(f'./raw/youtube/{item_id}.json')
+
     def save_response(self, video_id, data):
+        if self.raw_store is not None:
+            return self.raw_store.save('youtube', video_id, data)
         filename = f'./raw/youtube/{video_id}.json'
         try:
-            with open(filename, 'w') as f:
+            tmp_filename = f'{filename}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_filename, 'w') as f:
                 json.dump(data, f, indent=4)
+            os.replace(tmp_filename, filename)
             logger.info(f'Data has been successfully written to {filename}')
+            return True
         except IOError as e:
             logger.exception(f'An I/O error occurred while writing the file: {e}')
         except json.JSONDecodeError as e:
             logger.exception(f'An error occurred while encoding JSON: {e}')
         except Exception as e:
             logger.exception(f'An unexpected error occurred: {e}')
+        return False
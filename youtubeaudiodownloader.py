@@ -1,27 +1,205 @@
-from pytube import YouTube
+import json
 import os
+import queue
+import threading
+from collections import deque
+
+import requests
+from pytube import YouTube
+from loguru import logger
 
 
 class YouTubeAudioDownloader:
-    def __init__(self, download_path="downloads"):
+    """Downloads audio streams on background worker threads.
+
+    Progress is tracked in an append-only manifest (`manifest.jsonl`) in the
+    download directory: completed videos are never downloaded twice, queued
+    videos that did not finish are picked up again on the next start, and
+    partially downloaded `.part` files are resumed with HTTP range requests.
+    """
+
+    def __init__(self, download_path="downloads", workers=2, max_queue=100, disk_quota=None,
+                 chunk_size=1024 * 1024):
         self.download_path = download_path
         if not os.path.exists(download_path):
             os.makedirs(download_path)
 
+        self.workers = workers
+        self.disk_quota = disk_quota
+        self.chunk_size = chunk_size
+        self.manifest_path = os.path.join(download_path, 'manifest.jsonl')
+        self.manifest = self._load_manifest()
+        self.used_bytes = sum(entry.get('size', 0) for entry in self.manifest.values()
+                              if entry.get('status') == 'complete')
+
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue)
+        # Videos that did not fit in the queue; workers move them over as it drains.
+        self._deferred = deque()
+        self._deferred_lock = threading.Lock()
+        # Serializes enqueue's manifest check and the pending record that follows it.
+        self._enqueue_lock = threading.Lock()
+        self._threads = []
+        self._local = threading.local()
+
+    def _load_manifest(self):
+        manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        manifest[entry['video_id']] = entry
+        return manifest
+
+    def _record(self, video_id, **entry):
+        entry['video_id'] = video_id
+        with self._lock:
+            self.manifest[video_id] = entry
+            with open(self.manifest_path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def _session(self):
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'audio-download-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+        pending = [video_id for video_id, entry in self.manifest.items() if entry.get('status') == 'pending']
+        if pending:
+            logger.info(f"Resuming {len(pending)} pending audio downloads")
+        for video_id in pending:
+            self._put(video_id)
+
+    def enqueue(self, video_id):
+        """Queues a download without blocking the caller. If the queue is full the
+        video waits in an overflow list that the workers drain after the queue."""
+        with self._enqueue_lock:
+            # Started first so the resume of pending videos does not queue this one as well.
+            self.start()
+            entry = self.manifest.get(video_id, {})
+            if entry.get('status') == 'pending':
+                return
+            if entry.get('status') == 'complete':
+                if os.path.exists(entry.get('file', '')):
+                    return
+                logger.info(f"Audio file {entry.get('file')} of {video_id} is gone, downloading it again")
+                with self._lock:
+                    self.used_bytes -= entry.get('size', 0)
+            self._record(video_id, status='pending')
+        self._put(video_id)
+
+    def _put(self, video_id):
+        with self._deferred_lock:
+            # Behind videos already waiting, so they keep their order.
+            if self._deferred:
+                self._deferred.append(video_id)
+                return
+            try:
+                self._queue.put_nowait(video_id)
+            except queue.Full:
+                # A full queue means a worker is busy and will refill it from here.
+                self._deferred.append(video_id)
+
+    def _refill(self):
+        with self._deferred_lock:
+            while self._deferred:
+                try:
+                    self._queue.put_nowait(self._deferred[0])
+                except queue.Full:
+                    return
+                self._deferred.popleft()
+
+    def _worker(self):
+        while True:
+            video_id = self._queue.get()
+            try:
+                if video_id is None:
+                    return
+                self.fetch_audio(video_id)
+            finally:
+                # Refilled before task_done so close() does not see an empty queue
+                # while videos are still deferred.
+                self._refill()
+                self._queue.task_done()
+
+    def close(self, wait=True):
+        if wait:
+            self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
     def fetch_audio(self, video_url):
+        entry = self.manifest.get(video_url, {})
+        if entry.get('status') == 'complete' and os.path.exists(entry.get('file', '')):
+            logger.info(f"Audio for {video_url} already downloaded as {entry['file']}")
+            return entry['file']
+
         try:
             yt = YouTube(f"https://www.youtube.com/watch?v={video_url}")
-            audio_stream = yt.streams.filter(only_audio=True).first()
-            if audio_stream:
-                output_file = audio_stream.download(output_path=self.download_path)
-                base, ext = os.path.splitext(output_file)
-                new_file = base + '.mp3'
-                os.rename(output_file, new_file)
-                print(f"Audio file downloaded and saved as {new_file}")
-                return new_file
-            else:
-                print("No audio stream available for this video.")
+            audio_stream = yt.streams.filter(only_audio=True).order_by('abr').desc().first()
+            if not audio_stream:
+                logger.warning(f"No audio stream available for video {video_url}")
+                self._record(video_url, status='unavailable')
                 return None
+
+            # Streams are stored in their native container; nothing transcodes them to mp3.
+            extension = 'm4a' if audio_stream.subtype == 'mp4' else audio_stream.subtype
+            output_file = os.path.join(self.download_path, f'{video_url}.{extension}')
+            part_file = f'{output_file}.part'
+            total = audio_stream.filesize
+            offset = os.path.getsize(part_file) if os.path.exists(part_file) else 0
+
+            with self._lock:
+                if self.disk_quota is not None and self.used_bytes + total > self.disk_quota:
+                    logger.warning(f"Skipping audio for {video_url}: disk quota of {self.disk_quota} bytes reached")
+                    skip = True
+                else:
+                    self.used_bytes += total
+                    skip = False
+            if skip:
+                self._record(video_url, status='skipped_quota', size=total)
+                return None
+
+            try:
+                self._download(audio_stream.url, part_file, offset, total)
+            except Exception:
+                with self._lock:
+                    self.used_bytes -= total
+                raise
+
+            os.replace(part_file, output_file)
+            self._record(video_url, status='complete', file=output_file, size=total)
+            logger.info(f"Audio file downloaded and saved as {output_file}")
+            return output_file
         except Exception as e:
-            print(f"An error occurred: {e}")
-            return None
\ No newline at end of file
+            logger.exception(f"An error occurred while downloading audio for {video_url}: {e}")
+            return None
+
+    def _download(self, url, part_file, offset, total):
+        session = self._session()
+        with open(part_file, 'ab') as f:
+            while offset < total:
+                end = min(offset + self.chunk_size, total) - 1
+                response = session.get(url, headers={'Range': f'bytes={offset}-{end}'}, timeout=30)
+                response.raise_for_status()
+                if response.status_code != 206:
+                    # The server ignored the range and sent the whole stream.
+                    f.truncate(0)
+                    f.write(response.content)
+                    return
+                if not response.content:
+                    raise IOError(f"Empty chunk at offset {offset} of {total}")
+                f.write(response.content)
+                f.flush()
+                offset += len(response.content)